@@ -0,0 +1,32 @@
+import os
+import tempfile
+
+# Files that are replaced as a whole (WISE dump, metrics textfile, enrichment index) are written to a
+# temporary file next to the target and renamed over it, so readers never see a partial file.
+
+# Read once at import, before other threads run. The umask can only be read by setting it, doing that later
+# would briefly apply the temporary umask to files created by other threads.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def create_temp(path):
+    # Returns the path of a new, empty temporary file for replacing path
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=directory)
+    os.close(fd)
+    return tmp_path
+
+def replace(tmp_path, path):
+    # mkstemp() creates the file readable by its owner only, it gets the mode of a regular new file instead
+    os.chmod(tmp_path, 0o666 & ~_UMASK)
+    os.replace(tmp_path, path)
+
+def write_atomic(path, data):
+    tmp_path = create_temp(path)
+    try:
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import resource
+import shutil
+import tempfile
+import time
+import vcenter_simulator
+from field_sets import FieldSet, FIELD_SETS
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def bench_collection(simulator, vm_vcenter, name, collect):
+    simulator.reset_calls()
+    start = time.perf_counter()
+    vm_infos = list(collect())
+    elapsed = time.perf_counter() - start
+    count = max(len(vm_infos), 1)
+    print('%-28s %8d VMs %10.2f s %12.1f VMs/s %10.2f calls/VM %10.1f MB peak RSS'
+          % (name, len(vm_infos), elapsed, len(vm_infos) / elapsed, simulator.calls / count, peak_rss_mb()))
+    return vm_infos
+
+def bench_output(name, vm_infos, emit, close=None):
+    # Time spent in the output per VM, including closing/flushing it at the end
+    latencies = list()
+    start = time.perf_counter()
+    for vm_info in vm_infos:
+        t = time.perf_counter()
+        emit(vm_info)
+        latencies.append(time.perf_counter() - t)
+    if close is not None:
+        close()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    count = max(len(latencies), 1)
+    print('%-28s %10.2f s total %10.1f us/VM mean %10.1f us/VM p99 %10.1f MB peak RSS'
+          % (name, elapsed, sum(latencies) / count * 1e6, latencies[int(count * 0.99) - 1] * 1e6 if latencies else 0, peak_rss_mb()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks VM collection and the outputs against a simulated vCenter. No vCenter or network is needed.')
+    parser.add_argument('--vms',
+                        type=int,
+                        default=1000,
+                        help='Number of VMs in the simulated inventory. Default: 1000')
+    parser.add_argument('--nics',
+                        type=int,
+                        default=1,
+                        help='Number of NICs per VM. Default: 1')
+    parser.add_argument('--ips',
+                        type=int,
+                        default=2,
+                        help='Number of IPs per NIC. Default: 2')
+    parser.add_argument('--latency-ms',
+                        dest='latency_ms',
+                        type=float,
+                        default=1.0,
+                        help='Simulated round trip time of one vCenter call in milliseconds. Default: 1.0')
+    parser.add_argument('--object-latency-us',
+                        dest='object_latency_us',
+                        type=float,
+                        default=0.0,
+                        help='Simulated extra time per VM returned by a PropertyCollector call in microseconds. Default: 0')
+    parser.add_argument('--page-size',
+                        dest='page_size',
+                        type=int,
+                        default=1000,
+                        help='PropertyCollector page size in bulk collection mode. Default: 1000')
+    parser.add_argument('--field-set',
+                        dest='field_set',
+                        default='default',
+                        choices=['minimal', 'wise', 'default', 'full'],
+                        help='Set of VM fields to collect. Default: default')
+    parser.add_argument('--collection-modes',
+                        dest='collection_modes',
+                        nargs='+',
+                        default=['bulk', 'per-vm'],
+                        choices=['bulk', 'per-vm', 'watch'],
+                        help='Collection modes to benchmark. "watch" measures the initial snapshot of watch mode. Default: bulk per-vm')
+    parser.add_argument('--outputs',
+                        nargs='+',
+                        default=['file-json', 'file-ndjson', 'file-yaml', 'wise', 'duplicates'],
+                        choices=['file-json', 'file-ndjson', 'file-yaml', 'parquet', 'wise', 'duplicates', 'stdout', 'elasticsearch', 'kafka'],
+                        help='Outputs to benchmark. parquet needs pyarrow, elasticsearch and kafka need --es-hosts and --kafka-brokers. Default: file-json file-ndjson file-yaml wise duplicates')
+    parser.add_argument('--es-hosts',
+                        dest='es_hosts',
+                        nargs='+',
+                        help='Elasticsearch host(s) for the elasticsearch output benchmark.')
+    parser.add_argument('--kafka-brokers',
+                        dest='kafka_host',
+                        nargs='+',
+                        help='Kafka broker(s) for the kafka output benchmark.')
+    args = parser.parse_args()
+
+    print('Generating ' + str(args.vms) + ' VMs with ' + str(args.nics) + ' NICs and ' + str(args.ips) + ' IPs per NIC')
+    simulator = vcenter_simulator.Simulator(vms=args.vms,
+                                            nics=args.nics,
+                                            ips=args.ips,
+                                            latency=args.latency_ms / 1000,
+                                            object_latency=args.object_latency_us / 1e6)
+    vm_vcenter_module = vcenter_simulator.install(simulator)
+    vm_vcenter = vm_vcenter_module.VMvCenter(host='simulator',
+                                             user='benchmark',
+                                             password='',
+                                             port=443,
+                                             disable_ssl_verification=True,
+                                             folder_path='Lab',
+                                             field_set=FieldSet.from_names(FIELD_SETS[args.field_set]))
+    vm_vcenter.connect()
+
+    def watch_snapshot():
+        # The first rounds of watch mode hold the full inventory
+        for changes in vm_vcenter.watch_vm_info(max_wait=0, page_size=args.page_size):
+            if not changes:
+                return
+            yield from changes
+
+    collectors = {
+        'bulk': lambda: vm_vcenter.get_all_vm_info_bulk(page_size=args.page_size),
+        'per-vm': vm_vcenter.get_all_vm_info,
+        'watch': watch_snapshot,
+    }
+
+    print('\nCollection')
+    vm_infos = None
+    for mode in args.collection_modes:
+        vm_infos = bench_collection(simulator, vm_vcenter, mode, collectors[mode])
+
+    print('\nOutputs')
+    tmp_dir = tempfile.mkdtemp(prefix='vsphere-datascraper-bench-')
+    try:
+        for output in args.outputs:
+            if output.startswith('file-'):
+                from file_link import FileLink
+                file_format = output[len('file-'):]
+                file_link = FileLink(file_path=os.path.join(tmp_dir, 'dump.' + file_format), file_format=file_format)
+                bench_output(output, vm_infos, file_link.write, file_link.close)
+
+            elif output == 'parquet':
+                from columnar_link import ColumnarLink
+                columnar_link = ColumnarLink(directory=os.path.join(tmp_dir, 'columnar'))
+                bench_output(output, vm_infos, columnar_link.write, columnar_link.close)
+
+            elif output == 'wise':
+                from wise_link import WiseLink
+                wise_link = WiseLink(file_path=os.path.join(tmp_dir, 'wise.json'), wise_full_mode=True)
+                bench_output(output, vm_infos, wise_link.append, wise_link.write)
+
+            elif output == 'duplicates':
+                from duplicate_detection import DuplicateDetection
+                dupl = DuplicateDetection(mode='all')
+                bench_output(output, vm_infos, dupl.find_duplicates, dupl.get_report)
+
+            elif output == 'stdout':
+                with open(os.devnull, 'w') as devnull:
+                    bench_output(output, vm_infos, lambda vm_info: print(vm_info, file=devnull))
+
+            elif output == 'elasticsearch':
+                if not args.es_hosts:
+                    print('%-28s skipped, no --es-hosts given' % output)
+                    continue
+                from elastic_link import ElasticLink, ElasticFanout
+                ela_fanout = ElasticFanout([ElasticLink(ela_host=es_host, ela_index='vmware-assets-benchmark') for es_host in args.es_hosts])
+                ela_fanout.connect()
+                bench_output(output, vm_infos, ela_fanout.append, ela_fanout.close)
+
+            elif output == 'kafka':
+                if not args.kafka_host:
+                    print('%-28s skipped, no --kafka-brokers given' % output)
+                    continue
+                from kafka_link import KafkaLink
+                kafka_link = KafkaLink(kafka_host=args.kafka_host,
+                                       kafka_topic='vmware-assets-benchmark',
+                                       kafka_compression='gzip',
+                                       ip_split=False)
+                kafka_link.connect()
+                bench_output(output, vm_infos, kafka_link.push_to_server, kafka_link.close)
+    finally:
+        shutil.rmtree(tmp_dir)
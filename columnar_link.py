@@ -0,0 +1,167 @@
+import os
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+from datetime import datetime
+from serialization import encode
+
+# Columns with few distinct values. They are dictionary encoded in the files and loaded as categoricals
+# by pandas, each value is stored once instead of once per row.
+DICTIONARY_COLUMNS = ('snapshot', 'vcenter', 'datacenter', 'guest_state', 'os', 'power_state', 'host',
+                      'cluster', 'resource_pool')
+
+TIMESTAMP = pyarrow.timestamp('us', tz='UTC')
+
+# Columns every VM table has, in watch mode "removed" marks the VMs that are gone
+VM_COLUMNS = {'snapshot': None, 'ts': TIMESTAMP, 'removed': pyarrow.bool_()}
+
+# Columns of the IP table, one row per IP of a NIC. NICs without an IP get one row with an empty IP.
+IP_COLUMNS = {
+    'snapshot': None,
+    'ts': TIMESTAMP,
+    'vcenter': None,
+    'datacenter': None,
+    'instance_uuid': pyarrow.string(),
+    'name': pyarrow.string(),
+    'mac': pyarrow.string(),
+    'connected': pyarrow.bool_(),
+    'ip': pyarrow.string(),
+    'prefix_length': pyarrow.uint8(),
+    'version': pyarrow.uint8(),
+    'removed': pyarrow.bool_(),
+}
+
+class ColumnarLink:
+    # Writes the VMs as two tables, vms and ips, to DIR/vms/<snapshot>.parquet and DIR/ips/<snapshot>.parquet
+    # (.arrows for Arrow streams). The nested NIC and IP lists of a VM are flattened into the ips table.
+    # A directory of snapshots can be queried at once, e.g. in DuckDB: SELECT * FROM 'DIR/ips/*.parquet'.
+    # Rows are written in row groups (record batches for Arrow) of row_group_size rows as the VMs arrive.
+    def __init__(self, directory, file_format='parquet', compression='zstd', row_group_size=65536):
+        self.directory = directory
+        self.file_format = file_format
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.snapshot = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S') + 'Z'
+        self.vms = ColumnarTable(self, 'vms', VM_COLUMNS)
+        self.ips = ColumnarTable(self, 'ips', IP_COLUMNS)
+
+    def write(self, vm_info):
+        row = {key: value for key, value in vm_info.items() if key != 'nic'}
+        row['snapshot'] = self.snapshot
+        row['removed'] = bool(vm_info.get('removed'))
+        self.vms.append(row)
+
+        for nic in vm_info.get('nic') or []:
+            addresses = nic.get('IP') or [None]
+            for address in addresses:
+                row = {
+                    'snapshot': self.snapshot,
+                    'ts': vm_info.get('ts'),
+                    'vcenter': vm_info.get('vcenter'),
+                    'datacenter': vm_info.get('datacenter'),
+                    'instance_uuid': vm_info.get('instance_uuid'),
+                    'name': vm_info.get('name'),
+                    'mac': nic.get('mac'),
+                    'connected': nic.get('connected'),
+                    'removed': bool(vm_info.get('removed')),
+                }
+                if address is not None:
+                    # Addresses come as "IP/prefix length"
+                    ip, separator, prefix_length = address.partition('/')
+                    row['ip'] = ip
+                    row['prefix_length'] = int(prefix_length) if prefix_length.isdigit() else None
+                    row['version'] = 6 if ':' in ip else 4
+                self.ips.append(row)
+
+    def flush(self):
+        self.vms.write_row_group()
+        self.ips.write_row_group()
+
+    def close(self):
+        self.vms.close()
+        self.ips.close()
+
+
+class ColumnarTable:
+    # Gathers rows and writes them in row groups, turned into columns once per row group. The columns are
+    # the keys of the first row group. Columns without a type in types get theirs from their values:
+    # strings, numbers and booleans keep their type, lists of strings become list columns and everything
+    # else (e.g. custom attributes) is stored as JSON text. Keys first seen later are left out.
+    def __init__(self, link, name, types):
+        self.link = link
+        self.name = name
+        self.types = types
+        self.rows = list()
+        self.schema = None
+        self.writer = None
+
+    def append(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.link.row_group_size:
+            self.write_row_group()
+
+    def write_row_group(self):
+        if not self.rows:
+            return
+        # The rows are only dropped once they are written, a failed conversion or write keeps them
+        rows = self.rows
+        if self.schema is None:
+            names = dict.fromkeys(self.types)
+            for row in rows:
+                names.update(dict.fromkeys(row))
+            self.schema = pyarrow.schema([(name, self.types.get(name) or ColumnarTable.get_type(name, [row.get(name) for row in rows]))
+                                          for name in names])
+        arrays = [ColumnarTable.to_array([row.get(field.name) for row in rows], field.type) for field in self.schema]
+        batch = pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema)
+        if self.writer is None:
+            self.writer = self.open()
+        if self.link.file_format == 'parquet':
+            self.writer.write_batch(batch, row_group_size=len(rows))
+        else:
+            self.writer.write_batch(batch)
+        self.rows = list()
+
+    def open(self):
+        directory = os.path.join(self.link.directory, self.name)
+        os.makedirs(directory, exist_ok=True)
+        if self.link.file_format == 'parquet':
+            path = os.path.join(directory, self.link.snapshot.replace(':', '') + '.parquet')
+            return pyarrow.parquet.ParquetWriter(path,
+                                                 self.schema,
+                                                 compression=self.link.compression or 'none',
+                                                 use_dictionary=[column for column in DICTIONARY_COLUMNS
+                                                                 if column in self.schema.names])
+        # The Arrow stream format, unlike the file format, allows a new dictionary in every record batch
+        path = os.path.join(directory, self.link.snapshot.replace(':', '') + '.arrows')
+        options = pyarrow.ipc.IpcWriteOptions(compression=self.link.compression if self.link.compression in ('zstd', 'lz4') else None)
+        return pyarrow.ipc.new_stream(path, self.schema, options=options)
+
+    def get_type(name, values):
+        sample = next((value for value in values if value is not None), None)
+        if name in DICTIONARY_COLUMNS:
+            return pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+        if isinstance(sample, bool):
+            return pyarrow.bool_()
+        if isinstance(sample, int):
+            return pyarrow.int64()
+        if isinstance(sample, float):
+            return pyarrow.float64()
+        if isinstance(sample, list) and all(isinstance(item, str) for item in sample):
+            return pyarrow.list_(pyarrow.string())
+        # Anything else is stored as JSON text, e.g. custom attributes or portgroups
+        return pyarrow.string()
+
+    def to_array(values, arrow_type):
+        if arrow_type == TIMESTAMP:
+            # Parsed by Arrow, much faster than datetime.strptime() per value
+            return pyarrow.array(values, type=pyarrow.string()).cast(arrow_type)
+        if pyarrow.types.is_string(arrow_type) or pyarrow.types.is_dictionary(arrow_type):
+            values = [value if value is None or isinstance(value, str) else encode(value).decode() for value in values]
+        elif pyarrow.types.is_list(arrow_type):
+            values = [value if value is None or isinstance(value, list) else [str(value)] for value in values]
+        return pyarrow.array(values, type=arrow_type)
+
+    def close(self):
+        self.write_row_group()
+        if self.writer is not None:
+            self.writer.close()
@@ -1,38 +1,120 @@
+import csv
+import ipaddress
+import json
+
 class DuplicateDetection:
+    # Indexes hostnames, MACs and IPs to the (small) list of VM ids using them. The VMs themselves are
+    # kept only as (name, instance_uuid) tuples.
     def __init__(self, mode):
-        self.ip_duplicates = dict()
-        self.hostname_duplicates = dict()
         self.dupl_mode = mode
-    
+        self.vms = list()
+        self.hostname_duplicates = dict()
+        self.mac_duplicates = dict()
+        self.ip_duplicates = dict()
+        self.networks = dict()
+
     def find_duplicates(self, info):
+        vm_id = len(self.vms)
+        self.vms.append((info.get("name"), info.get("instance_uuid")))
+
         if self.dupl_mode == "hostname" or self.dupl_mode == "all":
-            hostname = info.get("host_name", "Unknown")
-            if hostname in self.hostname_duplicates:
-                infolist = self.hostname_duplicates[hostname]
-                infolist.append(info)
-                self.hostname_duplicates[hostname] = infolist
-            else:
-                self.hostname_duplicates[hostname] = [ info ]
-    
-        elif self.dupl_mode == "ip" or self.dupl_mode == "all":
+            hostname = info.get("host_name")
+            if hostname:
+                DuplicateDetection.add(self.hostname_duplicates, hostname.lower(), vm_id)
+
+        if self.dupl_mode == "mac" or self.dupl_mode == "all":
+            for nicinfo in info.get("nic", []):
+                mac = nicinfo.get("mac")
+                if mac and mac != "00:00:00:00:00:00":
+                    DuplicateDetection.add(self.mac_duplicates, mac.lower(), vm_id)
+
+        if self.dupl_mode == "ip" or self.dupl_mode == "all":
             for nicinfo in info.get("nic", []):
-                for ip in nicinfo.get("IP", "Unknown"):
-                    if ip in self.ip_duplicates:
-                        infolist = self.ip_duplicates[ip]
-                        infolist.append(info)
-                        self.hostname_duplicates[ip] = infolist
-                    else:
-                        self.hostname_duplicates[ip] = [ info ]
+                for ip in nicinfo.get("IP", []):
+                    interface = DuplicateDetection.normalize_ip(ip)
+                    if interface is None:
+                        continue
+                    DuplicateDetection.add(self.ip_duplicates, interface.ip, vm_id)
+                    # Host routes (/32, /128) are not subnets, they would overlap with every subnet containing them
+                    if interface.network.prefixlen < interface.max_prefixlen:
+                        DuplicateDetection.add(self.networks, interface.network, vm_id)
+
+    def add(index, key, vm_id):
+        vm_ids = index.get(key)
+        if vm_ids is None:
+            index[key] = [vm_id]
+        # VMs are added in order, so a VM listing the same key twice is always the last entry
+        elif vm_ids[-1] != vm_id:
+            vm_ids.append(vm_id)
+
+    def normalize_ip(ip):
+        # get_vm_info reports addresses as IP/prefix. Link-local and loopback addresses are expected to repeat
+        try:
+            interface = ipaddress.ip_interface(ip)
+        except ValueError:
+            return None
+        if interface.ip.is_link_local or interface.ip.is_loopback or interface.ip.is_unspecified:
+            return None
+        return interface
+
+    def find_subnet_overlaps(self):
+        # Checks every subnet against its supernets of the prefix lengths in use, instead of comparing all pairs
+        prefixlens = {4: set(), 6: set()}
+        for network in self.networks:
+            prefixlens[network.version].add(network.prefixlen)
+
+        overlaps = list()
+        for network, vm_ids in self.networks.items():
+            for prefixlen in sorted(prefixlens[network.version]):
+                if prefixlen >= network.prefixlen:
+                    break
+                supernet = network.supernet(new_prefix=prefixlen)
+                if supernet in self.networks:
+                    overlaps.append((network, vm_ids, supernet, self.networks[supernet]))
+        return overlaps
+
+    def get_vms(self, vm_ids):
+        return [{"name": self.vms[vm_id][0], "instance_uuid": self.vms[vm_id][1]} for vm_id in vm_ids]
+
+    def get_report(self):
+        report = dict()
+        for kind, index in (("hostname", self.hostname_duplicates),
+                            ("mac", self.mac_duplicates),
+                            ("ip", self.ip_duplicates)):
+            report[kind] = [{"key": str(key), "vms": self.get_vms(vm_ids)}
+                            for key, vm_ids in index.items() if len(vm_ids) > 1]
+        report["subnet_overlap"] = [{"network": str(network),
+                                     "vms": self.get_vms(vm_ids),
+                                     "overlaps": str(supernet),
+                                     "overlapping_vms": self.get_vms(supernet_vm_ids)}
+                                    for network, vm_ids, supernet, supernet_vm_ids in self.find_subnet_overlaps()]
+        return report
 
     def print_duplicates(self):
-        to_be_checked = list()
-        if self.dupl_mode == "hostname" or self.dupl_mode == "all":
-            to_be_checked.append(self.hostname_duplicates)
-        elif self.dupl_mode == "ip" or self.dupl_mode == "all":
-            to_be_checked.append(self.ip_duplicates)
-
-        for dupldict in to_be_checked:
-            for key, value in dupldict.items():
-                if len(value) > 1:
-                    print("Found duplicates for " + str(key))
-                    #print(value)
+        report = self.get_report()
+        for kind in ("hostname", "mac", "ip"):
+            for entry in report[kind]:
+                print("Found duplicates for " + entry["key"] + ": " +
+                      ", ".join(str(vm["name"]) + " (" + str(vm["instance_uuid"]) + ")" for vm in entry["vms"]))
+        for entry in report["subnet_overlap"]:
+            print("Found overlapping subnets " + entry["network"] + " and " + entry["overlaps"] + ": " +
+                  ", ".join(str(vm["name"]) for vm in entry["vms"]) + " / " +
+                  ", ".join(str(vm["name"]) for vm in entry["overlapping_vms"]))
+
+    def write_report(self, path, report_format="json"):
+        report = self.get_report()
+        with open(path, "w", newline="") as fd:
+            if report_format == "json":
+                json.dump(report, fd, indent=2)
+                return
+
+            writer = csv.writer(fd)
+            writer.writerow(["type", "key", "name", "instance_uuid"])
+            for kind in ("hostname", "mac", "ip"):
+                for entry in report[kind]:
+                    for vm in entry["vms"]:
+                        writer.writerow([kind, entry["key"], vm["name"], vm["instance_uuid"]])
+            for entry in report["subnet_overlap"]:
+                key = entry["network"] + " in " + entry["overlaps"]
+                for vm in entry["vms"] + entry["overlapping_vms"]:
+                    writer.writerow(["subnet_overlap", key, vm["name"], vm["instance_uuid"]])
@@ -1,36 +1,186 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk, parallel_bulk
+from elasticsearch.helpers import parallel_bulk
 from datetime import datetime
+from serialization import encode
+
+# Bulk item statuses worth retrying. Transport errors are reported without a numeric status
+RETRY_STATUSES = (429, 502, 503, 504)
 
 class ElasticLink:
-    def __init__(self, ela_host, ela_index):
+    def __init__(self, ela_host, ela_index,
+                 op_type='index',
+                 flush_docs=1000,
+                 flush_bytes=5 * 1024 * 1024,
+                 flush_interval=5,
+                 thread_count=4,
+                 chunk_size=500,
+                 max_retries=3,
+                 verbose=False):
         self.ela_host = ela_host
         self.ela_index = ela_index
+        self.op_type = op_type
+        self.flush_docs = flush_docs
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.thread_count = thread_count
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.verbose = verbose
+
+        self.buffer = list()
+        self.buffer_bytes = 0
+        self.buffer_since = None
+        self.pushed = 0
+        self.failed = 0
+        self.retried = 0
+        # Records of the failed documents, until taken by take_failed()
+        self.failed_infos = list()
+        # Several buffers can be sent at once, the counters are updated under the lock
+        self.lock = threading.Lock()
 
     def connect(self):
         self.es = Elasticsearch(self.ela_host)
 
-    def push_to_server(self, info):
-        try:
-            bulk(self.es, [{
-                    '_op_type': 'create',
-                    '_index': self.ela_index,
-                    '@timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f') + 'Z',
-                    'info': info
-                }])
-        except Exception as e:
-            print('Unable to push to Elasticsearch server: ', e)
-
-    #def push_all_to_server(self, docs):
-    #    for success, info in parallel_bulk(self.es, self._pre_process_docs(docs)):
-    #        if not success:
-    #            print('Push failed: ', info)
-
-    #def _pre_process_docs(self, docs):
-    #    for doc in docs:
-    #        yield {
-    #            '_index': self.ela_index,
-    #            '_timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f') + 'Z',
-    #            '_id': doc['name'],
-    #            'doc': doc
-    #        }
+    def append(self, info):
+        # Buffers the document, call flush() or flush_if_needed() to send the buffer. Buffers are only
+        # checked against the flush thresholds when documents are appended or flushed, a buffer older than
+        # flush_interval waits for the next append or flush.
+        if self.buffer_since is None:
+            self.buffer_since = time.monotonic()
+        self.buffer.append(self._pre_process_doc(info))
+        # The encoding is shared with the other outputs and clusters, the ES client serializes the
+        # documents itself when sending them
+        self.buffer_bytes += len(encode(info))
+
+    def should_flush(self):
+        if not self.buffer:
+            return False
+        return len(self.buffer) >= self.flush_docs or \
+            self.buffer_bytes >= self.flush_bytes or \
+            time.monotonic() - self.buffer_since >= self.flush_interval
+
+    def flush_if_needed(self):
+        if self.should_flush():
+            self.flush()
+
+    def flush(self):
+        self.send(self.take())
+
+    def take(self):
+        # Empties the buffer and returns its documents
+        docs = self.buffer
+        self.buffer = list()
+        self.buffer_bytes = 0
+        self.buffer_since = None
+        return docs
+
+    def send(self, docs):
+        attempt = 0
+        while docs:
+            retry = list()
+            try:
+                # parallel_bulk keeps the order of the actions, so results can be matched back to the docs
+                results = parallel_bulk(self.es, docs,
+                                        thread_count=self.thread_count,
+                                        chunk_size=self.chunk_size,
+                                        raise_on_error=False,
+                                        raise_on_exception=False)
+                pushed = 0
+                for doc, (success, item) in zip(docs, results):
+                    if success:
+                        pushed += 1
+                        continue
+                    status = list(item.values())[0].get('status')
+                    if attempt < self.max_retries and (status in RETRY_STATUSES or not isinstance(status, int)):
+                        retry.append(doc)
+                    else:
+                        self.count_failed([doc])
+                        print('Push failed: ', item)
+                self.count('pushed', pushed)
+            except Exception as e:
+                print('Unable to push to Elasticsearch server: ', e)
+                retry = docs if attempt < self.max_retries else list()
+                if not retry:
+                    self.count_failed(docs)
+
+            if retry:
+                attempt += 1
+                self.count('retried', len(retry))
+                if self.verbose:
+                    print('Retrying ' + str(len(retry)) + ' documents on ' + str(self.ela_host) + ' (attempt ' + str(attempt) + ')')
+                time.sleep(min(2 ** attempt, 30))
+            docs = retry
+
+    def count(self, result, count):
+        with self.lock:
+            setattr(self, result, getattr(self, result) + count)
+
+    def count_failed(self, docs):
+        with self.lock:
+            self.failed += len(docs)
+            self.failed_infos.extend(doc['info'] for doc in docs)
+
+    def take_failed(self):
+        # Returns the records that failed since the last call
+        with self.lock:
+            infos = self.failed_infos
+            self.failed_infos = list()
+        return infos
+
+    def _pre_process_doc(self, info):
+        doc = {
+            '_op_type': self.op_type,
+            '_index': self.ela_index,
+            '@timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f') + 'Z',
+            'info': info
+        }
+        # Deterministic IDs let re-scrapes overwrite the previous document of the VM instead of duplicating it
+        if self.op_type == 'index' and info.get('instance_uuid'):
+            doc['_id'] = info['instance_uuid']
+        return doc
+
+
+class ElasticFanout:
+    # Sends the same documents to several ES clusters, flushing the clusters concurrently
+    # workers: number of threads appending at the same time, each can be sending to every cluster
+    def __init__(self, ela_links, workers=1):
+        self.ela_links = ela_links
+        self.executor = ThreadPoolExecutor(max_workers=max(len(ela_links) * workers, 1))
+        self.lock = threading.Lock()
+
+    def connect(self):
+        for ela_link in self.ela_links:
+            ela_link.connect()
+
+    def append(self, info):
+        # The lock only guards the buffers, they are sent after it is released. Batches emitted at the same
+        # time (--es-workers) are sent concurrently then.
+        with self.lock:
+            for ela_link in self.ela_links:
+                ela_link.append(info)
+            if not any(ela_link.should_flush() for ela_link in self.ela_links):
+                return
+            buffers = [(ela_link, ela_link.take()) for ela_link in self.ela_links]
+        self._send(buffers)
+
+    def flush(self):
+        with self.lock:
+            buffers = [(ela_link, ela_link.take()) for ela_link in self.ela_links]
+        self._send(buffers)
+
+    def _send(self, buffers):
+        # Sends to the clusters concurrently and waits for all of them
+        for future in [self.executor.submit(ela_link.send, docs) for ela_link, docs in buffers if docs]:
+            future.result()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+
+    def report(self):
+        for ela_link in self.ela_links:
+            print('Elasticsearch ' + str(ela_link.ela_host) + ': pushed ' + str(ela_link.pushed) +
+                  ', failed ' + str(ela_link.failed) + ', retried ' + str(ela_link.retried) + ' documents.')
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import ipaddress
+import json
+import mmap
+import struct
+import threading
+from array import array
+from atomic_file import write_atomic
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+# IP and MAC lookup index of the scraped VMs, for enriching traffic or log data by address.
+#
+# IndexBuilder turns VM records into a compact binary image. EnrichmentIndex answers lookups directly
+# from the image, which can be a memory-mapped file, so loading it does not parse anything:
+#   - exact IPv4/IPv6 lookups: sorted address arrays, binary search
+#   - longest prefix lookups over the subnets of the VMs: one sorted array per prefix length, the prefix
+#     lengths in use are tried from the longest down
+#   - MAC lookups: sorted array of 48 bit MACs
+#
+# Image layout, in native byte order: magic, version, then the sections below. Every section starts with
+# a uint64 count and is followed by its arrays, each padded to 8 bytes.
+#   strings   offsets uint32[count + 1], UTF-8 data
+#   assets    uint32[count * 5]           string ids of name, hostname, os, instance_uuid, vcenter
+#   bindings  uint32[count * 3]           asset id, string ids of MAC and subnet
+#   ip4       keys uint32[count], binding ids uint32[count]
+#   ip6       keys uint64[count * 2] (high, low), binding ids uint32[count]
+#   net4      prefix lengths uint32[count], keys uint32[count], subnet string ids uint32[count]
+#   net6      prefix lengths uint32[count], keys uint64[count * 2], subnet string ids uint32[count]
+#   mac       keys uint64[count], binding ids uint32[count]
+
+MAGIC = b'VSEI'
+FORMAT_VERSION = 1
+ASSET_FIELDS = ('asset', 'hostname', 'os', 'uuid', 'vcenter')
+MAX_BITS = {4: 32, 6: 128}
+
+def parse_mac(value):
+    # Accepts 00:50:56:aa:bb:cc, 00-50-56-AA-BB-CC and 0050.56aa.bbcc
+    digits = value.replace(':', '').replace('-', '').replace('.', '')
+    if len(digits) != 12:
+        raise ValueError('Invalid MAC address ' + value)
+    return int(digits, 16)
+
+def _pad(data):
+    data += bytes(-len(data) % 8)
+    return data
+
+
+class IndexBuilder:
+    def __init__(self):
+        # String id 0 is the empty string, used for missing values
+        self.strings = {'': 0}
+        self.assets = dict()
+        self.bindings = dict()
+        self.binding_assets = list()
+        self.ips = {4: dict(), 6: dict()}
+        self.networks = {4: dict(), 6: dict()}
+        self.macs = dict()
+        # Addresses and MACs used by more than one VM, the first VM is kept
+        self.conflicts = 0
+
+    def string(self, value):
+        value = '' if value is None else str(value)
+        string_id = self.strings.get(value)
+        if string_id is None:
+            string_id = self.strings[value] = len(self.strings)
+        return string_id
+
+    def add(self, vm_info):
+        asset = (self.string(vm_info.get('name')), self.string(vm_info.get('host_name')),
+                 self.string(vm_info.get('os')), self.string(vm_info.get('instance_uuid')),
+                 self.string(vm_info.get('vcenter')))
+        asset_id = self.assets.setdefault(asset, len(self.assets))
+
+        for nic in vm_info.get('nic') or []:
+            mac = nic.get('mac')
+            mac_key = None
+            if mac:
+                try:
+                    mac_key = parse_mac(mac)
+                except ValueError:
+                    pass
+            for ip in nic.get('IP') or []:
+                # get_vm_info reports addresses as IP/prefix
+                address, separator, prefixlen = ip.partition('/')
+                try:
+                    address = ipaddress.ip_address(address)
+                    prefixlen = int(prefixlen) if separator else address.max_prefixlen
+                except ValueError:
+                    continue
+                key = int(address)
+                subnet_id = 0
+                if prefixlen < address.max_prefixlen:
+                    host_bits = address.max_prefixlen - prefixlen
+                    subnet_id = self.subnet(address.version, prefixlen, key >> host_bits << host_bits)
+                binding_id = self.binding(asset_id, mac, subnet_id)
+                self.add_key(self.ips[address.version], key, binding_id)
+            if mac_key is not None:
+                self.add_key(self.macs, mac_key, self.binding(asset_id, mac, 0))
+
+    def subnet(self, version, prefixlen, network):
+        networks = self.networks[version]
+        subnet_id = networks.get((prefixlen, network))
+        if subnet_id is None:
+            subnet_id = networks[(prefixlen, network)] = self.string(ipaddress.ip_network((network, prefixlen)))
+        return subnet_id
+
+    def binding(self, asset_id, mac, subnet_id):
+        binding = (asset_id, self.string(mac), subnet_id)
+        binding_id = self.bindings.get(binding)
+        if binding_id is None:
+            binding_id = self.bindings[binding] = len(self.bindings)
+            self.binding_assets.append(asset_id)
+        return binding_id
+
+    def add_key(self, index, key, binding_id):
+        existing = index.setdefault(key, binding_id)
+        if self.binding_assets[existing] != self.binding_assets[binding_id]:
+            self.conflicts += 1
+
+    def build(self):
+        # Returns the binary image
+        out = bytearray(struct.pack('=4sI', MAGIC, FORMAT_VERSION))
+
+        def section(count, *arrays):
+            out.extend(struct.pack('=Q', count))
+            for data in arrays:
+                out.extend(_pad(data))
+
+        def keys128(keys):
+            return array('Q', [part for key in keys for part in (key >> 64, key & 0xffffffffffffffff)]).tobytes()
+
+        strings = [value.encode('utf-8') for value in self.strings]
+        offsets = [0]
+        for data in strings:
+            offsets.append(offsets[-1] + len(data))
+        section(len(strings), array('I', offsets).tobytes(), b''.join(strings))
+        section(len(self.assets), array('I', [string_id for asset in self.assets for string_id in asset]).tobytes())
+        section(len(self.bindings), array('I', [value for binding in self.bindings for value in binding]).tobytes())
+
+        for version in (4, 6):
+            ips = sorted(self.ips[version].items())
+            keys = [key for key, value in ips]
+            section(len(ips),
+                    array('I', keys).tobytes() if version == 4 else keys128(keys),
+                    array('I', [value for key, value in ips]).tobytes())
+        for version in (4, 6):
+            networks = sorted(self.networks[version].items())
+            keys = [key for (prefixlen, key), value in networks]
+            section(len(networks),
+                    array('I', [prefixlen for (prefixlen, key), value in networks]).tobytes(),
+                    array('I', keys).tobytes() if version == 4 else keys128(keys),
+                    array('I', [value for key, value in networks]).tobytes())
+        macs = sorted(self.macs.items())
+        section(len(macs), array('Q', [key for key, value in macs]).tobytes(), array('I', [value for key, value in macs]).tobytes())
+        return bytes(out)
+
+    def write(self, path):
+        # Replaced as a whole, readers keep their mapping of the previous file
+        write_atomic(path, self.build())
+
+
+class _Keys128:
+    # Sequence view of 128 bit keys stored as (high, low) uint64 pairs, for bisect
+    def __init__(self, words):
+        self.words = words
+
+    def __len__(self):
+        return len(self.words) // 2
+
+    def __getitem__(self, i):
+        return self.words[2 * i] << 64 | self.words[2 * i + 1]
+
+
+class EnrichmentIndex:
+    def __init__(self, data):
+        # data: bytes or a memory map of an image written by IndexBuilder
+        self.view = memoryview(data)
+        magic, version = struct.unpack_from('=4sI', self.view, 0)
+        if magic != MAGIC:
+            raise ValueError('Not an enrichment index')
+        if version != FORMAT_VERSION:
+            raise ValueError('Unsupported enrichment index version ' + str(version) +
+                             ' (or written on a machine with a different byte order)')
+        self.offset = 8
+
+        count = self.count()
+        self.string_offsets = self.take('I', count + 1)
+        self.string_data = self.take('B', self.string_offsets[-1])
+        self.assets = self.take('I', self.count() * 5)
+        self.bindings = self.take('I', self.count() * 3)
+
+        self.ips = dict()
+        for version, width in ((4, 1), (6, 2)):
+            count = self.count()
+            keys = self.take('I' if version == 4 else 'Q', count * width)
+            self.ips[version] = (keys if version == 4 else _Keys128(keys), self.take('I', count))
+
+        self.networks = dict()
+        for version, width in ((4, 1), (6, 2)):
+            count = self.count()
+            prefixlens = self.take('I', count)
+            keys = self.take('I' if version == 4 else 'Q', count * width)
+            values = self.take('I', count)
+            # Start and end of the entries of every prefix length, longest prefix first
+            segments = dict()
+            for i, prefixlen in enumerate(prefixlens):
+                start, end = segments.get(prefixlen, (i, i))
+                segments[prefixlen] = (start, i + 1)
+            self.networks[version] = (keys if version == 4 else _Keys128(keys), values,
+                                      sorted(segments.items(), reverse=True))
+
+        count = self.count()
+        self.macs = (self.take('Q', count), self.take('I', count))
+
+    def count(self):
+        count = struct.unpack_from('=Q', self.view, self.offset)[0]
+        self.offset += 8
+        return count
+
+    def take(self, typecode, count):
+        size = struct.calcsize(typecode) * count
+        data = self.view[self.offset:self.offset + size].cast(typecode)
+        self.offset += size + (-size % 8)
+        return data
+
+    def load(path):
+        # Maps the file into memory, pages are read by the OS as lookups touch them
+        with open(path, 'rb') as file:
+            return EnrichmentIndex(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def get_string(self, string_id):
+        return bytes(self.string_data[self.string_offsets[string_id]:self.string_offsets[string_id + 1]]).decode('utf-8')
+
+    def get_binding(self, binding_id):
+        asset_id, mac_id, subnet_id = self.bindings[binding_id * 3:binding_id * 3 + 3]
+        result = dict()
+        for field, string_id in zip(ASSET_FIELDS, self.assets[asset_id * 5:asset_id * 5 + 5]):
+            if string_id:
+                result[field] = self.get_string(string_id)
+        if mac_id:
+            result['mac'] = self.get_string(mac_id)
+        if subnet_id:
+            result['subnet'] = self.get_string(subnet_id)
+        return result
+
+    def find(keys, values, key, start=0, end=None):
+        end = len(keys) if end is None else end
+        i = bisect.bisect_left(keys, key, start, end)
+        if i < end and keys[i] == key:
+            return values[i]
+        return None
+
+    def lookup_ip(self, value):
+        # Returns the VM using the address, otherwise the longest VM subnet containing it, or None
+        address = ipaddress.ip_address(value)
+        key = int(address)
+        keys, values = self.ips[address.version]
+        binding_id = EnrichmentIndex.find(keys, values, key)
+        if binding_id is not None:
+            return self.get_binding(binding_id)
+
+        keys, values, segments = self.networks[address.version]
+        max_bits = MAX_BITS[address.version]
+        for prefixlen, (start, end) in segments:
+            network = key >> (max_bits - prefixlen) << (max_bits - prefixlen)
+            subnet_id = EnrichmentIndex.find(keys, values, network, start, end)
+            if subnet_id is not None:
+                return {'subnet': self.get_string(subnet_id)}
+        return None
+
+    def lookup_mac(self, value):
+        keys, values = self.macs
+        binding_id = EnrichmentIndex.find(keys, values, parse_mac(value))
+        if binding_id is None:
+            return None
+        return self.get_binding(binding_id)
+
+
+class EnrichmentServer:
+    # Answers lookups over HTTP: GET /ip/<address> and GET /mac/<address> return a JSON list of
+    # {"field": ..., "value": ...}, empty when nothing is known. The index can be replaced while serving.
+    # This is a lookup API of its own, not the binary POST /get protocol of the Arkime wiseService, so
+    # Arkime capture cannot query it directly. Use the WISE dump (--wise) as a wiseService file source for that.
+    def __init__(self, index, port, address=''):
+        self.index = index
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parts = self.path.split('?')[0].strip('/').split('/', 1)
+                lookups = {'ip': server.index.lookup_ip, 'mac': server.index.lookup_mac}
+                if len(parts) != 2 or parts[0] not in lookups:
+                    self.send_error(404)
+                    return
+                try:
+                    result = lookups[parts[0]](unquote(parts[1]))
+                except ValueError as e:
+                    self.send_error(400, str(e))
+                    return
+                body = json.dumps([{'field': field, 'value': value} for field, value in (result or {}).items()]).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http_server = ThreadingHTTPServer((address, port), Handler)
+        threading.Thread(target=self.http_server.serve_forever, name='enrichment', daemon=True).start()
+
+    def close(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves an enrichment index written with --enrichment-index as a JSON lookup API, e.g. GET /ip/10.0.0.1 or GET /mac/00:50:56:00:00:01. '
+                                                 'This is not the Arkime wiseService protocol and does not replace wiseService, Arkime capture cannot query it directly.')
+    parser.add_argument('index_path',
+                        help='Enrichment index file.')
+    parser.add_argument('--port',
+                        type=int,
+                        default=8081,
+                        help='Port to listen on. Default: 8081')
+    parser.add_argument('--address',
+                        default='127.0.0.1',
+                        help='Address to listen on. Default: 127.0.0.1')
+    args = parser.parse_args()
+
+    server = EnrichmentServer(EnrichmentIndex.load(args.index_path), args.port, args.address)
+    print('Serving ' + args.index_path + ' on ' + args.address + ':' + str(args.port))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.close()
@@ -0,0 +1,157 @@
+import sys
+from datetime import datetime
+
+# Field sets map output keys of the VM record to vSphere VirtualMachine property paths. Only the paths of
+# the selected fields are requested from vCenter. References to other objects (hosts, datastores, ...) are
+# resolved to names in bulk by the collector, see VMvCenter.prepare().
+
+def to_plain(value, resolver):
+    # Makes a vSphere value JSON serializable, references to other objects are replaced by their names
+    if value is None or type(value) in (str, int, float, bool):
+        return value
+    # pyVmomi enums (e.g. runtime.powerState) are str subclasses, and its long type an int subclass. Records
+    # only hold builtin types, YAML would write subclasses as tagged Python objects.
+    if isinstance(value, bool):
+        return bool(value)
+    if isinstance(value, str):
+        return str(value)
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    if resolver.is_reference(value):
+        return resolver.get_name(value)
+    if isinstance(value, (list, tuple)):
+        return [to_plain(item, resolver) for item in value]
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def convert_nic(values, resolver):
+    nics = list()
+    for nic in values[0] or []:
+        if nic.ipConfig is not None:
+            nics.append({
+                'connected': nic.connected,
+                'mac': nic.macAddress,
+                'IP': [''.join([adr.ipAddress, '/', str(adr.prefixLength)]) for adr in nic.ipConfig.ipAddress],
+            })
+    return nics
+
+def convert_cluster(values, resolver):
+    if values[0] is None:
+        return None
+    parent = resolver.get_parent(values[0])
+    return resolver.get_name(parent) if parent is not None else None
+
+def convert_custom_attributes(values, resolver):
+    return {resolver.get_custom_field_name(custom_value.key): custom_value.value for custom_value in values[0] or []}
+
+def convert_portgroups(values, resolver):
+    # Ethernet cards are the devices with a MAC address. Standard portgroups are named in the backing,
+    # distributed portgroups are referenced by key, which is the ID of one of the VM networks.
+    networks = {network._moId: resolver.get_name(network) for network in values[1] or []}
+    portgroups = list()
+    for device in values[0] or []:
+        if not hasattr(device, 'macAddress') or device.macAddress is None:
+            continue
+        backing = device.backing
+        portgroup = getattr(backing, 'deviceName', None)
+        port = getattr(backing, 'port', None)
+        if portgroup is None and port is not None:
+            portgroup = networks.get(port.portgroupKey, port.portgroupKey)
+        portgroups.append({
+            'mac': device.macAddress,
+            'connected': device.connectable.connected if device.connectable is not None else None,
+            'portgroup': portgroup,
+        })
+    return portgroups
+
+
+def to_interned(value, resolver):
+    # For strings repeated across many VMs (OS names, states), every VM then holds the same string object.
+    # sys.intern() only takes exact str objects, not str subclasses such as pyVmomi enums.
+    value = to_plain(value, resolver)
+    if isinstance(value, str) and type(value) is not str:
+        value = str(value)
+    return sys.intern(value) if type(value) is str else value
+
+
+class Field:
+    def __init__(self, paths, convert=None, parent_paths=(), intern=False):
+        self.paths = tuple(paths)
+        plain = to_interned if intern else to_plain
+        self.convert = convert or (lambda values, resolver: plain(values[0], resolver))
+        # Paths holding references whose parent object is needed (host -> cluster)
+        self.parent_paths = tuple(parent_paths)
+
+
+FIELDS = {
+    'host_name': Field(['guest.hostName']),
+    'guest_state': Field(['guest.guestState'], intern=True),
+    'os': Field(['guest.guestFullName'], intern=True),
+    'name': Field(['summary.config.name']),
+    'instance_uuid': Field(['summary.config.instanceUuid']),
+    'power_state': Field(['runtime.powerState'], intern=True),
+    'nic': Field(['guest.net'], convert_nic),
+    'host': Field(['runtime.host']),
+    'cluster': Field(['runtime.host'], convert_cluster, parent_paths=['runtime.host']),
+    'resource_pool': Field(['resourcePool']),
+    'datastores': Field(['datastore']),
+    'networks': Field(['network']),
+    'custom_attributes': Field(['customValue'], convert_custom_attributes),
+    'portgroups': Field(['config.hardware.device', 'network'], convert_portgroups),
+}
+
+FIELD_SETS = {
+    'minimal': ['name', 'instance_uuid', 'nic'],
+    'wise': ['host_name', 'os', 'name', 'instance_uuid', 'nic'],
+    'default': ['host_name', 'guest_state', 'os', 'name', 'instance_uuid', 'power_state', 'nic'],
+    'full': ['host_name', 'guest_state', 'os', 'name', 'instance_uuid', 'power_state', 'nic',
+             'host', 'cluster', 'resource_pool', 'datastores', 'networks', 'custom_attributes', 'portgroups'],
+}
+
+
+class FieldSet:
+    def __init__(self, fields):
+        # fields: ordered dict of output key -> Field
+        self.fields = fields
+        self.paths = list(dict.fromkeys(path for field in fields.values() for path in field.paths))
+        self.parent_paths = list(dict.fromkeys(path for field in fields.values() for path in field.parent_paths))
+
+    def from_names(names):
+        unknown = [name for name in names if name not in FIELDS]
+        if unknown:
+            raise ValueError('Unknown field(s) ' + ', '.join(unknown) + '. Known fields: ' + ', '.join(FIELDS))
+        return FieldSet({name: FIELDS[name] for name in names})
+
+    def from_file(path):
+        # YAML or JSON: either a list of known field names, or a mapping of output key to property path.
+        # In a mapping, a key without a path refers to the known field of that name.
+        import yaml
+
+        with open(path, 'r') as file:
+            config = yaml.safe_load(file)
+        if isinstance(config, list):
+            return FieldSet.from_names(config)
+        if not isinstance(config, dict):
+            raise ValueError(path + ' must hold a list of field names or a mapping of keys to property paths')
+
+        fields = dict()
+        for key, property_path in config.items():
+            if property_path is None:
+                if key not in FIELDS:
+                    raise ValueError('Unknown field ' + key + ' in ' + path + ', give its property path')
+                fields[key] = FIELDS[key]
+            else:
+                fields[key] = Field([property_path])
+        return FieldSet(fields)
+
+    def build(self, props, resolver):
+        vm_info = dict()
+        for key, field in self.fields.items():
+            vm_info[key] = field.convert([props.get(path) for path in field.paths], resolver)
+        return vm_info
+
+
+DEFAULT_FIELD_SET = FieldSet.from_names(FIELD_SETS['default'])
@@ -1,20 +1,85 @@
-import json
+import gzip
+import os
 import yaml
+from serialization import Record, get_json_encoder, encode
+
+# The C based YAML emitter is much faster, it is available when PyYAML is built against libyaml
+class YamlDumper(getattr(yaml, 'CDumper', yaml.Dumper)):
+    pass
+
+# Records are written as plain mappings, not as tagged Python objects that safe_load cannot read
+YamlDumper.add_representer(Record, yaml.representer.SafeRepresenter.represent_dict)
 
 class FileLink:
-    def __init__(self, file_path, file_format):
+    def __init__(self, file_path, file_format,
+                 compression=None,
+                 rotate_bytes=0,
+                 rotate_count=0,
+                 json_backend='auto',
+                 buffer_size=1024 * 1024):
         self.file_path = file_path
         self.file_format = file_format
+        self.compression = compression
+        self.rotate_bytes = rotate_bytes
+        self.rotate_count = rotate_count
+        self.buffer_size = buffer_size
+        self.encode = get_json_encoder(json_backend)
+        self.file_index = 0
+        self.fd = None
         
         try:
-            self.fd = open(self.file_path, 'w')
+            self.open()
         except Exception as e:
             print('Error occurred: ', e)
 
+    def open(self):
+        self.written_bytes = 0
+        self.written_count = 0
+        path = self.get_path()
+        if self.compression == 'gzip':
+            self.fd = gzip.open(path, 'wb', compresslevel=6)
+        elif self.compression == 'zstd':
+            import zstandard
+            self.fd = zstandard.ZstdCompressor().stream_writer(open(path, 'wb', buffering=self.buffer_size))
+        else:
+            self.fd = open(path, 'wb', buffering=self.buffer_size)
+
+    def get_path(self):
+        # With rotation every file gets a sequence number before the extension, e.g. dump.00001.json
+        if not (self.rotate_bytes or self.rotate_count):
+            return self.file_path
+        root, ext = os.path.splitext(self.file_path)
+        if ext in ('.gz', '.zst'):
+            root, inner = os.path.splitext(root)
+            ext = inner + ext
+        return root + '.' + str(self.file_index).zfill(5) + ext
+
     def write(self, info):
         if self.file_format == 'json':
-            json.dump(info, self.fd)
+            data = encode(info)
+
+        elif self.file_format == 'ndjson':
+            data = encode(info, self.encode) + b'\n'
 
         elif self.file_format == 'yaml':
-            self.fd.write('---\n')
-            yaml.dump(info, self.fd)
+            data = ('---\n' + yaml.dump(info, Dumper=YamlDumper)).encode('utf-8')
+
+        # Rotating before the write instead of after it avoids leaving an empty last file
+        if (self.rotate_bytes and self.written_bytes >= self.rotate_bytes) or \
+                (self.rotate_count and self.written_count >= self.rotate_count):
+            self.rotate()
+
+        self.fd.write(data)
+        self.written_bytes += len(data)
+        self.written_count += 1
+
+    def rotate(self):
+        self.fd.close()
+        self.file_index += 1
+        self.open()
+
+    def flush(self):
+        self.fd.flush()
+
+    def close(self):
+        self.fd.close()
@@ -1,56 +1,110 @@
 from kafka.errors import KafkaError
 from kafka import KafkaProducer
 import json
-import copy
+import threading
+from serialization import encode
 
 class KafkaLink:
-    def __init__(self, kafka_host, kafka_topic, kafka_compression, ip_split):
+    def __init__(self, kafka_host, kafka_topic, kafka_compression, ip_split,
+                 linger_ms=20,
+                 batch_size=64 * 1024,
+                 buffer_memory=32 * 1024 * 1024,
+                 acks=1,
+                 max_in_flight=5,
+                 verbose=False):
         self.kafka_host = kafka_host
         self.kafka_topic = kafka_topic
         self.kafka_compression = kafka_compression
         self.ip_split = ip_split
+        self.linger_ms = linger_ms
+        self.batch_size = batch_size
+        self.buffer_memory = buffer_memory
+        self.acks = acks
+        self.max_in_flight = max_in_flight
+        self.verbose = verbose
+
+        # Delivery results are reported from the producer I/O thread
+        self.lock = threading.Lock()
+        self.delivered = 0
+        self.failed = 0
+        # Records of the failed messages, until taken by take_failed()
+        self.failed_infos = list()
 
     def connect(self):
-        self.kafka = KafkaProducer(bootstrap_servers=self.kafka_host, retries=5, compression_type=self.kafka_compression)
+        self.kafka = KafkaProducer(bootstrap_servers=self.kafka_host,
+                                   retries=5,
+                                   compression_type=self.kafka_compression,
+                                   linger_ms=self.linger_ms,
+                                   batch_size=self.batch_size,
+                                   buffer_memory=self.buffer_memory,
+                                   acks=self.acks,
+                                   max_in_flight_requests_per_connection=self.max_in_flight)
 
     def push_to_server(self, info):
         if not self.ip_split: #Normal operation
             self.publish_to_kafka(info)
 
         else: #Split each IP per one line in Kafka, backward compatibility with older XS software
-            line = copy.deepcopy(info)
-            line.pop('nic', [])
+            # The VM part of the line is the same for every IP, so it is serialized only once and
+            # the per NIC and per IP fields are spliced into it
+            line = {k: v for k, v in info.items() if k != 'nic'}
+            key = bytes(info.get("name", "Unknown"), 'utf-8')
+            vm_part = json.dumps(line)[1:-1]
 
             nics = info.get('nic', [])
             for nic in nics:
-                line['mac'] = nic.get('mac')
-                line['nic_connected'] = nic.get('connected')
+                nic_part = json.dumps({'mac': nic.get('mac'), 'nic_connected': nic.get('connected')})[1:-1]
+                if vm_part:
+                    nic_part = vm_part + ', ' + nic_part
                 ips = nic.get('IP', [])
                 for ip in ips:
-                    line['ip'] = ip
-                    self.publish_to_kafka(line) #Push single lines with one IP to kafka
+                    self.publish_raw(key, bytes('{' + nic_part + ', "ip": ' + json.dumps(ip) + '}', 'utf-8'), info) #Push single lines with one IP to kafka
 
 
     def publish_to_kafka(self, line):
+        self.publish_raw(bytes(line.get("name", "Unknown"), 'utf-8'), encode(line), line)
+
+    def publish_raw(self, key, value, info):
+        # info: the record the message was made from, reported by take_failed() when the message fails
         try:
-            self.kafka.send(self.kafka_topic, key=bytes(line.get("name", "Unknown"), 'utf-8'), value=bytes(json.dumps(line), 'utf-8'))
+            future = self.kafka.send(self.kafka_topic, key=key, value=value)
+            future.add_callback(self._on_delivery)
+            future.add_errback(self._on_error, info)
         except Exception as e:
+            self.count_failed(info)
+            print('Unable to publish to Kafka server: ', e)
+
+    def _on_delivery(self, record_metadata):
+        with self.lock:
+            self.delivered += 1
+
+    def _on_error(self, info, e):
+        self.count_failed(info)
+        if self.verbose:
             print('Unable to publish to Kafka server: ', e)
 
-    #def push_all_to_server(self, docs):
-    #    for success, info in parallel_bulk(self.es, self._pre_process_docs(docs)):
-    #        if not success:
-    #            print('Push failed: ', info)
-
-
-    #def _pre_process_docs(self, docs):
-    #    for doc in docs:
-    #        yield {
-    #            "ts": timestamp,
-    #            "ansible_name": name, 
-    #            "host_name": hostname, 
-    #            "domain": domain, 
-    #            "ip": ip, 
-    #            "mac": mac, 
-    #            "team": team
-    #        }
+    def count_failed(self, info):
+        with self.lock:
+            self.failed += 1
+            self.failed_infos.append(info)
+
+    def take_failed(self):
+        # Returns the records of the messages that failed since the last call, once per message
+        with self.lock:
+            infos = self.failed_infos
+            self.failed_infos = list()
+        return infos
+
+    def flush(self):
+        # Blocks until every message sent so far has been delivered or has failed
+        try:
+            self.kafka.flush()
+        except KafkaError as e:
+            print('Unable to flush messages to Kafka server: ', e)
+
+    def close(self):
+        self.flush()
+        self.kafka.close()
+
+    def report(self):
+        print('Kafka: delivered ' + str(self.delivered) + ', failed ' + str(self.failed) + ' messages.')
@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
 
 import argparse
-from getpass import getpass
-from vm_vcenter import VMvCenter
+import time
+import metrics
+from target_pool import TargetPool, load_targets, build_vcenters
+from pipeline import Pipeline
+from sinks import get_sink_classes, parse_sink_options, track
+from field_sets import FieldSet, FIELD_SETS
 
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Data and IP scraper from VMware vCenter. Supports output to Kafka, Elasticsearch, file or stdout. \nNote, current implementation selects the first "Datacenter" entity in the vCenter.')
+    parser = argparse.ArgumentParser(description='Data and IP scraper from VMware vCenter. Supports output to Kafka, Elasticsearch, file or stdout. \nNote, unless --datacenter is given the first "Datacenter" entity in the vCenter is selected.')
     # vSphere args
     parser.add_argument('-vh', '--vhost',
-                        required=True,
+                        required=False,
                         action='store',
                         help='vSphere service address to connect to')
     parser.add_argument('-vp', '--vport',
@@ -22,7 +26,7 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Disable ssl host certificate verification')
     parser.add_argument('-u', '--user',
-                        required=True,
+                        required=False,
                         action='store',
                         help='User name to use when connecting to vSphere')
     parser.add_argument('-p', '--password',
@@ -35,9 +39,99 @@ if __name__ == '__main__':
                         action='store',
                         help='Read password from a file. Mind the permissions of this file. Prompts for password if not provided.')
     parser.add_argument('-f', '--folder',
-                        required=True,
+                        required=False,
+                        nargs='+',
+                        help='Path(s) to the VM folder(s) to scrape (recursively), separated with a whitespace. Do not prefix the paths with /. VMs in overlapping folders are scraped once.')
+    parser.add_argument('-xf', '--exclude-folder',
+                        dest='exclude_folder',
+                        nargs='+',
+                        help='Folder path pattern(s) to leave out, including their subfolders. Glob patterns (e.g. "Lab/*/Archive"), or regular expressions prefixed with "re:".')
+    parser.add_argument('-dc', '--datacenter',
+                        required=False,
                         action='store',
-                        help='Path to the VM folder to scrape (recursively). Do not prefix the path with /.')
+                        help='Name of the datacenter containing the folder. Default: the first datacenter in the vCenter')
+    parser.add_argument('--targets',
+                        dest='targets_file',
+                        required=False,
+                        action='store',
+                        help='YAML or JSON file listing several vCenter/datacenter/folder targets to scrape concurrently. Keys: vhost, vport, user, password, password_file, disable_ssl_verification, datacenter, folder (a path or a list of paths), exclude (a list of patterns). Missing keys are taken from the command line arguments.')
+    parser.add_argument('--max-workers',
+                        dest='max_workers',
+                        type=int,
+                        default=8,
+                        help='Maximum number of targets scraped at the same time. Default: 8')
+    parser.add_argument('--max-per-vcenter',
+                        dest='max_per_vcenter',
+                        type=int,
+                        default=2,
+                        help='Maximum number of targets scraped at the same time from one vCenter. Ignored in watch mode. Default: 2')
+    parser.add_argument('--session-cache',
+                        dest='session_cache',
+                        help='File to keep vCenter session cookies in between runs, so a run reuses the session of the previous one instead of logging in again. Sessions are not logged out at exit then. The file grants access to vCenter and is created readable by its owner only.')
+    parser.add_argument('--keepalive',
+                        dest='keepalive',
+                        type=int,
+                        default=300,
+                        help='Seconds between keepalive calls that stop an idle vCenter session from expiring, 0 disables them. Expired sessions are logged in again either way. Default: 300')
+    parser.add_argument('--rate-limit',
+                        dest='rate_limit',
+                        type=float,
+                        default=0,
+                        help='Maximum number of calls per second to one vCenter, shared by all targets on it. In per-vm collection mode every property read counts as a call. 0 disables the limit. Default: 0')
+    parser.add_argument('--rate-burst',
+                        dest='rate_burst',
+                        type=int,
+                        help='Number of calls that can be made at once after an idle time, above the rate limit. Default: the rate limit')
+    parser.add_argument('--max-concurrency',
+                        dest='max_concurrency',
+                        type=int,
+                        default=8,
+                        help='Maximum number of concurrent calls to one vCenter. The actual limit starts at 1, grows while vCenter answers quickly and is cut when its response time rises. Default: 8')
+    parser.add_argument('--latency-tolerance',
+                        dest='latency_tolerance',
+                        type=float,
+                        default=2.0,
+                        help='Factor by which a call can be slower than the fastest call of its kind before the concurrency to the vCenter is lowered. Default: 2.0')
+    parser.add_argument('--prioritize',
+                        dest='prioritize',
+                        action='store_true',
+                        help='Collect powered on VMs and VMs whose guest info changed recently first, ordered by one extra call per target. Ignored in watch mode.')
+    parser.add_argument('--collection-mode',
+                        dest='collection_mode',
+                        default='bulk',
+                        choices=['bulk', 'per-vm'],
+                        help='How VM properties are collected. "bulk" uses the PropertyCollector to fetch all VMs in pages, "per-vm" reads every property of every VM separately (slow). Default: bulk')
+    parser.add_argument('--page-size',
+                        dest='page_size',
+                        type=int,
+                        default=1000,
+                        help='Number of VMs to retrieve per PropertyCollector call in bulk collection mode. Default: 1000')
+    parser.add_argument('--field-set',
+                        dest='field_set',
+                        default='default',
+                        choices=['minimal', 'wise', 'default', 'full'],
+                        help='Set of VM fields to collect. "minimal": name, instance_uuid, nic. "wise": minimal plus host_name and os. "default": wise plus guest_state and power_state. "full": default plus host, cluster, resource_pool, datastores, networks, custom_attributes and portgroups. Default: default')
+    parser.add_argument('--fields',
+                        dest='fields',
+                        help='Comma separated list of VM fields to collect, overrides --field-set. E.g. name,nic,host')
+    parser.add_argument('--fields-file',
+                        dest='fields_file',
+                        help='YAML or JSON file with the VM fields to collect, overrides --field-set and --fields. Either a list of field names or a mapping of output key to vSphere property path (e.g. "annotation: config.annotation"); keys mapped to nothing refer to the known field of that name.')
+    parser.add_argument('--watch',
+                        dest='watch',
+                        action='store_true',
+                        default=False,
+                        help='Keep running after the initial scrape and only publish new, changed and removed VMs. Removed VMs are published with "removed": true.')
+    parser.add_argument('--watch-interval',
+                        dest='watch_interval',
+                        type=int,
+                        default=60,
+                        help='Maximum number of seconds to wait for changes from vCenter in one watch round. Default: 60')
+    parser.add_argument('--queue-size',
+                        dest='queue_size',
+                        type=int,
+                        default=1000,
+                        help='Maximum number of VMs waiting in the queue of each output. Collection slows down when an output falls this far behind. Default: 1000')
     # Elasticsearch args
     parser.add_argument('-eh', '--es-hosts',
                         dest='es_hosts', 
@@ -48,6 +142,46 @@ if __name__ == '__main__':
                         action='store',
                         default='vmware-assets', 
                         help='Elasticsearch index name')
+    parser.add_argument('--es-op-type',
+                        dest='es_op_type',
+                        default='index',
+                        choices=['index', 'create'],
+                        help='Bulk operation to use. "index" uses the VM instance UUID as document ID so re-scrapes update the existing document, "create" adds a new document every time. Default: index')
+    parser.add_argument('--es-flush-docs',
+                        dest='es_flush_docs',
+                        type=int,
+                        default=1000,
+                        help='Send the buffered documents once this many have been collected. Default: 1000')
+    parser.add_argument('--es-flush-bytes',
+                        dest='es_flush_bytes',
+                        type=int,
+                        default=5 * 1024 * 1024,
+                        help='Send the buffered documents once they reach this size in bytes. Default: 5242880')
+    parser.add_argument('--es-flush-interval',
+                        dest='es_flush_interval',
+                        type=float,
+                        default=5,
+                        help='Send the buffered documents once the oldest of them is this many seconds old. The age is checked when the next VM is passed to the output or at the end of a run or watch round. Default: 5')
+    parser.add_argument('--es-threads',
+                        dest='es_threads',
+                        type=int,
+                        default=4,
+                        help='Number of parallel bulk requests per Elasticsearch cluster. Default: 4')
+    parser.add_argument('--es-chunk-size',
+                        dest='es_chunk_size',
+                        type=int,
+                        default=500,
+                        help='Number of documents per bulk request. Default: 500')
+    parser.add_argument('--es-max-retries',
+                        dest='es_max_retries',
+                        type=int,
+                        default=3,
+                        help='How many times to retry documents rejected with a retryable error. Default: 3')
+    parser.add_argument('--es-workers',
+                        dest='es_workers',
+                        type=int,
+                        default=1,
+                        help='Number of batches passed to the Elasticsearch output at the same time. Default: 1')
     # Kafka args
     parser.add_argument('--kafka-topic', 
                         dest='kafka_topic', 
@@ -67,6 +201,36 @@ if __name__ == '__main__':
                         action='store_true',
                         default=False, 
                         help='Splits each found IP[4|6] per one line published to Kafka')
+    parser.add_argument('--kafka-linger-ms',
+                        dest='kafka_linger_ms',
+                        type=int,
+                        default=20,
+                        help='Time in milliseconds the producer waits for more messages before sending a batch. Default: 20')
+    parser.add_argument('--kafka-batch-size',
+                        dest='kafka_batch_size',
+                        type=int,
+                        default=64 * 1024,
+                        help='Maximum size of a message batch per partition in bytes. Default: 65536')
+    parser.add_argument('--kafka-buffer-memory',
+                        dest='kafka_buffer_memory',
+                        type=int,
+                        default=32 * 1024 * 1024,
+                        help='Memory in bytes the producer may use to buffer unsent messages. Default: 33554432')
+    parser.add_argument('--kafka-acks',
+                        dest='kafka_acks',
+                        default='1',
+                        choices=['0', '1', 'all'],
+                        help='Number of broker acknowledgements required for a message to be delivered. Default: 1')
+    parser.add_argument('--kafka-max-in-flight',
+                        dest='kafka_max_in_flight',
+                        type=int,
+                        default=5,
+                        help='Maximum number of unacknowledged requests per broker connection. Default: 5')
+    parser.add_argument('--kafka-workers',
+                        dest='kafka_workers',
+                        type=int,
+                        default=1,
+                        help='Number of batches passed to the Kafka output at the same time. Default: 1')
     # File store args
     parser.add_argument('-o', '--output', '--file', 
                         dest='file_path', 
@@ -74,8 +238,28 @@ if __name__ == '__main__':
     parser.add_argument('--file-format', 
                         dest='file_format', 
                         default='json',
-                        choices=['json', 'yaml'],
-                        help='File format for the dumpfile. Default: json')
+                        choices=['json', 'ndjson', 'yaml'],
+                        help='File format for the dumpfile. "ndjson" writes one JSON document per line. Default: json')
+    parser.add_argument('--file-compression',
+                        dest='file_compression',
+                        default=None,
+                        choices=['gzip', 'zstd'],
+                        help='Compress the dumpfile. Use one of: gzip, zstd (pip3 install zstandard). Default: no compression')
+    parser.add_argument('--file-rotate-bytes',
+                        dest='file_rotate_bytes',
+                        type=int,
+                        default=0,
+                        help='Start a new dumpfile after this many (uncompressed) bytes. Files are numbered, e.g. dump.00001.json. Default: 0 (no rotation)')
+    parser.add_argument('--file-rotate-count',
+                        dest='file_rotate_count',
+                        type=int,
+                        default=0,
+                        help='Start a new dumpfile after this many VMs. Default: 0 (no rotation)')
+    parser.add_argument('--json-backend',
+                        dest='json_backend',
+                        default='auto',
+                        choices=['auto', 'orjson', 'ujson', 'json'],
+                        help='JSON serializer for the ndjson file format. "auto" uses orjson or ujson when installed. Default: auto')
     # Wise output args
     parser.add_argument('-w', '--wise', 
                         dest='wise_path', 
@@ -85,6 +269,16 @@ if __name__ == '__main__':
                         action='store_true',
                         default=False, 
                         help='Enable WISE full output dump (adds fields for MAC, OS, hostname).')
+    parser.add_argument('--wise-format',
+                        dest='wise_format',
+                        default='json',
+                        choices=['json', 'ndjson'],
+                        help='WISE dump format. "json" writes one JSON array, "ndjson" one entry per line. Default: json')
+    parser.add_argument('--wise-gzip',
+                        dest='wise_gzip',
+                        action='store_true',
+                        default=False,
+                        help='Compress the WISE dump with gzip.')
     # Duplicate IP and hostname detection
     parser.add_argument('-dupl', '--duplicates',
                         dest='duplicate_detection',
@@ -94,7 +288,48 @@ if __name__ == '__main__':
     parser.add_argument('--duplicate-mode',
                         dest='duplicate_mode',
                         default="all", 
-                        help='Select duplicate detection mode. Valid values: "ip", "hostname", "all". Default: "all".')
+                        choices=['ip', 'hostname', 'mac', 'all'],
+                        help='Select duplicate detection mode. Valid values: "ip", "hostname", "mac", "all". IP mode also reports overlapping subnets. Default: "all".')
+    parser.add_argument('--duplicate-report',
+                        dest='duplicate_report',
+                        help='Write the found duplicates with the conflicting VM names and UUIDs to this file.')
+    parser.add_argument('--duplicate-report-format',
+                        dest='duplicate_report_format',
+                        default='json',
+                        choices=['json', 'csv'],
+                        help='Format of the duplicate report. Default: json')
+
+    # Change tracking args
+    parser.add_argument('--changes-only',
+                        dest='changes_only',
+                        action='store_true',
+                        default=False,
+                        help='Only publish VMs that are new or changed since the previous run, and removal events ("removed": true) for VMs that disappeared. The WISE dump and duplicate detection still see every VM.')
+    parser.add_argument('--snapshot-db',
+                        dest='snapshot_db',
+                        default='vsphere-datascraper-snapshot.db',
+                        help='SQLite file remembering what was published in previous runs, used with --changes-only. Use a separate file for every set of targets. Default: vsphere-datascraper-snapshot.db')
+
+    # Metrics args
+    parser.add_argument('--metrics-port',
+                        dest='metrics_port',
+                        type=int,
+                        help='Expose Prometheus metrics over HTTP on this port, useful in watch mode.')
+    parser.add_argument('--metrics-file',
+                        dest='metrics_file',
+                        help='Write Prometheus metrics to this file at the end of the run (and after every watch round), e.g. for the node_exporter textfile collector.')
+
+    # Output batching args
+    parser.add_argument('--batch-size',
+                        dest='batch_size',
+                        nargs='+',
+                        metavar='OUTPUT=SIZE',
+                        help='Number of VMs passed to an output at once, e.g. "elasticsearch=1000 file=5000". Outputs: elasticsearch, kafka, file, wise, stdout, duplicates, enrichment and installed output plugins. Default: 500 for elasticsearch and kafka, 1 for stdout, 1000 for the others')
+    parser.add_argument('--batch-timeout',
+                        dest='batch_timeout',
+                        nargs='+',
+                        metavar='OUTPUT=SECONDS',
+                        help='Maximum number of seconds a VM waits for its batch to fill up before it is passed to the output, e.g. "kafka=0.1". Default: 1 for every output')
 
     # Other args
     parser.add_argument('--stdout', '--console',
@@ -114,127 +349,188 @@ if __name__ == '__main__':
                         help='Increases verbosity. Produces information messages about the progress.')
 
 
+    # Output plugins can add their own args
+    sink_classes = get_sink_classes()
+    for sink_class in sink_classes.values():
+        sink_class.add_arguments(parser)
+
     # Get args
     args = parser.parse_args()
-    es_enabled = True if args.es_hosts else False
-    kafka_enabled = True if args.kafka_host else False
-    file_enabled = True if args.file_path else False
-    wise_enabled = True if args.wise_path else False
-    stdout_enabled = True if not (es_enabled or kafka_enabled or file_enabled or wise_enabled) or args.stdout else False
-    duplicate_detection = True if args.duplicate_detection else False
-
-    # Conditional imports to avoid unnecessary dependency requirements
-    if es_enabled:
-        from elastic_link import ElasticLink
-    if kafka_enabled:
-        from kafka_link import KafkaLink
-    if file_enabled:
-        from file_link import FileLink
-    if wise_enabled:
-        from wise_link import WiseLink
-    if stdout_enabled and args.stdout_pretty:
-        import pprint
-        pp = pprint.PrettyPrinter(indent=2)
-    if duplicate_detection:
-        from duplicate_detection import DuplicateDetection
-
-    # Check password
-    if not (args.password or args.password_file):
-        args.password = getpass(
-            prompt='Please enter password for host %s and user %s: '
-                   % (args.vhost, args.user))
-
-    if args.password_file:
-        with open(args.password_file, 'r') as file:
-            args.password = file.read().replace('\n', '')
-
-    # Init vCenter obj
-    vm_vcenter = VMvCenter(host=args.vhost,
-                           user=args.user,
-                           password=args.password,
-                           port=args.vport,
-                           disable_ssl_verification=args.disable_ssl_verification,
-                           folder_path=args.folder)
-
-    # Init ElasticLink obj
-    ela_links = list()
-    if es_enabled:
-        for es_host in args.es_hosts:
-            if args.verbose:
-                print('Connecting to ES host: ' + str(es_host))
-            ela_links.append(ElasticLink(ela_host=es_host, ela_index=args.index))
-
-        for ela_link in ela_links:
-            ela_link.connect()
-
-    # Init KafkaLink obj
-    if kafka_enabled:
-        if args.verbose:
-            print('Connecting to Kafka hosts: ' + str(args.kafka_host))
-
-        kafka_link = KafkaLink(kafka_host=args.kafka_host,
-                            kafka_topic=args.kafka_topic,
-                            kafka_compression=args.kafka_compression,
-                            ip_split=args.ip_split)
-        kafka_link.connect()
-    
-    # Init FileLink obj
-    if file_enabled:
-        if args.verbose:
-            print('Opening ' + args.file_path + ' for writing.')
-        file_link = FileLink(file_path=args.file_path, file_format=args.file_format)
-    
-    # Init WiseLink obj
-    if wise_enabled:
-        if args.verbose:
-            print('Opening ' + args.wise_path + ' for writing.')
-        wise_link = WiseLink(file_path=args.wise_path, wise_full_mode=args.wise_full_mode)
-    
-    # Load duplicate detection module
-    if duplicate_detection:
-        if args.verbose:
-            print('Enabling duplicate hostname and IP detection')
-        dupl = DuplicateDetection(mode=args.duplicate_mode)
+    for sink_class in sink_classes.values():
+        sink_class.check_arguments(parser, args)
+    start_time = time.monotonic()
 
-    # Initiate connection
+    # Collect targets
+    defaults = {
+        'vhost': args.vhost,
+        'vport': args.vport,
+        'user': args.user,
+        'password': args.password,
+        'password_file': args.password_file,
+        'disable_ssl_verification': args.disable_ssl_verification,
+        'datacenter': args.datacenter,
+        'folder': args.folder,
+        'exclude': args.exclude_folder,
+    }
+    if args.targets_file:
+        try:
+            targets = load_targets(args.targets_file, defaults)
+        except (ValueError, OSError) as e:
+            parser.error(str(e))
+    elif args.vhost and args.user and args.folder:
+        targets = [defaults]
+    else:
+        parser.error('either --targets or --vhost, --user and --folder are required')
+
+    # Select the fields to collect
+    try:
+        if args.fields_file:
+            field_set = FieldSet.from_file(args.fields_file)
+        elif args.fields:
+            field_set = FieldSet.from_names([name.strip() for name in args.fields.split(',') if name.strip()])
+        else:
+            field_set = FieldSet.from_names(FIELD_SETS[args.field_set])
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+
+    # Init vCenter objs
+    vm_vcenters = build_vcenters(targets,
+                                 field_set=field_set,
+                                 session_cache=args.session_cache,
+                                 keepalive=args.keepalive,
+                                 rate_limit=args.rate_limit,
+                                 rate_burst=args.rate_burst,
+                                 max_concurrency=args.max_concurrency,
+                                 latency_tolerance=args.latency_tolerance,
+                                 prioritize=args.prioritize)
+    target_pool = TargetPool(vm_vcenters,
+                             max_workers=args.max_workers,
+                             max_per_vcenter=args.max_per_vcenter,
+                             verbose=args.verbose)
+
+    # Init outputs
+    sinks = [sink_class.from_args(args) for name, sink_class in sink_classes.items()
+             if name != 'stdout' and sink_class.enabled(args)]
+    # Console output is the default when nothing else is published
+    if args.stdout or all(sink.name == 'duplicates' for sink in sinks):
+        sinks.insert(len([sink for sink in sinks if sink.name != 'duplicates']),
+                     sink_classes['stdout'].from_args(args))
     try:
-        vm_vcenter.connect()
+        batch_sizes = parse_sink_options(args.batch_size, int, '--batch-size')
+        batch_timeouts = parse_sink_options(args.batch_timeout, float, '--batch-timeout')
+    except ValueError as e:
+        parser.error(str(e))
+    unknown = (set(batch_sizes) | set(batch_timeouts)) - set(sink_classes)
+    if unknown:
+        parser.error('unknown output(s) ' + ', '.join(sorted(unknown)) + ' in --batch-size or --batch-timeout')
+
+    pipeline = Pipeline(queue_size=args.queue_size)
+    for sink in sinks:
+        pipeline.add_sink(sink,
+                          batch_size=batch_sizes.get(sink.name),
+                          batch_timeout=batch_timeouts.get(sink.name))
+    pipeline.start()
+
+    # Outputs that always hold the whole inventory get every VM, even with --changes-only
+    inventory_stages = {sink.name for sink in sinks if sink.inventory}
+    event_stages = {stage.name for stage in pipeline.stages} - inventory_stages
+
+    snapshot_store = None
+    if args.changes_only:
+        from snapshot_store import SnapshotStore
+        snapshot_store = SnapshotStore(args.snapshot_db)
+
+    def commit_snapshot():
+        # VMs are only recorded as published when every event output delivered them, the changes of the
+        # others are published again. Failures are known once the outputs have been flushed.
+        failed = pipeline.take_failed(event_stages)
+        if snapshot_store is None:
+            return
+        keys = {SnapshotStore.get_key(vm_info) for vm_info in failed}
+        if keys:
+            print('Outputs failed to deliver ' + str(len(keys)) + ' VMs, their changes will be published again.')
+            snapshot_store.rollback(keys)
+        snapshot_store.commit()
+
+    def publish(vm_info):
+        if snapshot_store is None or snapshot_store.check(vm_info):
+            metrics.vms_published.inc()
+            pipeline.put(vm_info)
+            return True
+        pipeline.put(vm_info, stages=inventory_stages)
+        return False
+
+    if args.metrics_port:
+        metrics.run_duration_seconds.set_function(lambda: time.monotonic() - start_time)
+        metrics.REGISTRY.serve(args.metrics_port)
+
+    def write_metrics():
+        metrics.last_success_seconds.set(time.time())
+        if args.metrics_file:
+            metrics.run_duration_seconds.set(time.monotonic() - start_time)
+            metrics.REGISTRY.write_textfile(args.metrics_file)
+
+    counter = 0
+    published = 0
+
+    # Watch mode, publish only the changes until interrupted
+    if args.watch:
+        inventory = dict()
+        try:
+            watch = lambda vm_vcenter: vm_vcenter.watch_vm_info(max_wait=args.watch_interval, page_size=args.page_size)
+            for changes in target_pool.run(watch, limit_concurrency=False):
+                if not changes:
+                    continue
+
+                for vm_info in changes:
+                    counter += 1
+                    track(inventory, vm_info)
+                    if publish(vm_info):
+                        published += 1
+
+                pipeline.flush()
+                commit_snapshot()
+                write_metrics()
+                if args.verbose:
+                    print('Received ' + str(len(changes)) + ' changes, ' + str(len(inventory)) + ' VMs in inventory.')
+        except KeyboardInterrupt:
+            pass
+
+        pipeline.close()
         if args.verbose:
-            print('Connected to ' + str(args.vhost))
-    except Exception as e:
-        print('Unable to connect: ', e)
-        exit(1)
+            pipeline.report()
+            print('Stopped watching. Received ' + str(counter) + ' and published ' + str(published) + ' changes.')
+        exit(0)
 
     # Going through each VM
-    counter = 0
-    for vm in vm_vcenter.get_vm_iterator_from_folder():
+    if args.collection_mode == 'bulk':
+        collect = lambda vm_vcenter: vm_vcenter.get_all_vm_info_bulk(page_size=args.page_size)
+    else:
+        collect = lambda vm_vcenter: vm_vcenter.get_all_vm_info()
+
+    for vm_info in target_pool.run(collect):
         counter += 1
-        try:
-            vm_info = vm_vcenter.get_vm_info(vm)
-            if es_enabled:
-                for ela_link in ela_links:
-                    ela_link.push_to_server(vm_info)
-            if kafka_enabled:
-                kafka_link.push_to_server(vm_info)
-            if file_enabled:
-                file_link.write(vm_info)
-            if wise_enabled:
-                wise_link.append(vm_info)
-            if stdout_enabled:
-                if args.stdout_pretty:
-                    pp.pprint(vm_info)
-                else:
-                    print(vm_info)
-
-            if duplicate_detection:
-                dupl.find_duplicates(vm_info)
-
-        except Exception as e:
-            print('Error occurred: ', e)
-
-    if wise_enabled:
-        wise_link.write()
-    if duplicate_detection:
-        dupl.print_duplicates()
+        if publish(vm_info):
+            published += 1
+
+    if snapshot_store is not None:
+        # Only targets scraped without any errors can tell which VMs were deleted
+        incomplete = {(vm_vcenter.host, vm_vcenter.datacenter_name) for vm_vcenter in vm_vcenters
+                      if vm_vcenter in target_pool.failed or vm_vcenter.errors}
+        completed = {(vm_vcenter.host, vm_vcenter.datacenter_name) for vm_vcenter in vm_vcenters
+                     if (vm_vcenter.host, vm_vcenter.datacenter_name) not in incomplete and (vm_vcenter.host, None) not in incomplete}
+        for vm_info in snapshot_store.tombstones(completed):
+            published += 1
+            metrics.vms_published.inc()
+            pipeline.put(vm_info, stages=event_stages)
+
+    pipeline.close()
+    commit_snapshot()
+    if snapshot_store is not None:
+        snapshot_store.close()
+    write_metrics()
     if args.verbose:
-        print('Done! Collected info from ' + str(counter) + ' hosts.')
+        pipeline.report()
+        print('Done! Collected info from ' + str(counter) + ' hosts, published ' + str(published) + '.')
+    if len(target_pool.failed) == len(vm_vcenters):
+        exit(1)
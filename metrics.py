@@ -0,0 +1,186 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from atomic_file import write_atomic
+
+# Minimal Prometheus text format metrics. Exposed over HTTP with serve() or written for the node_exporter
+# textfile collector with write_textfile().
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                          for name, value in pairs) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = dict()
+
+    def header(self, metric_type, name=None):
+        name = name or self.name
+        return ['# HELP ' + name + ' ' + self.documentation, '# TYPE ' + name + ' ' + metric_type]
+
+
+class Counter(Metric):
+    def inc(self, amount=1, *labelvalues):
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = self.header('counter', self.name + '_total')
+        with self.lock:
+            for labelvalues, value in self.values.items():
+                lines.append(self.name + '_total' + _format_labels(self.labelnames, labelvalues) + ' ' + _format_value(value))
+        return lines
+
+
+class Gauge(Metric):
+    # The value can also come from a function called on every render, e.g. a queue size
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.functions = dict()
+
+    def set(self, value, *labelvalues):
+        with self.lock:
+            self.values[labelvalues] = value
+
+    def set_function(self, function, *labelvalues):
+        with self.lock:
+            self.functions[labelvalues] = function
+
+    def render(self):
+        lines = self.header('gauge')
+        with self.lock:
+            values = dict(self.values)
+            functions = dict(self.functions)
+        for labelvalues, function in functions.items():
+            try:
+                values[labelvalues] = function()
+            except Exception:
+                continue
+        for labelvalues, value in values.items():
+            lines.append(self.name + _format_labels(self.labelnames, labelvalues) + ' ' + _format_value(value))
+        return lines
+
+
+class Histogram(Metric):
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, *labelvalues):
+        with self.lock:
+            counts = self.values.get(labelvalues)
+            if counts is None:
+                counts = self.values[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+                    break
+            counts[1] += value
+            counts[2] += 1
+
+    def time(self, *labelvalues):
+        return _Timer(self, labelvalues)
+
+    def render(self):
+        lines = self.header('histogram')
+        with self.lock:
+            for labelvalues, (buckets, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, buckets):
+                    cumulative += bucket_count
+                    lines.append(self.name + '_bucket' + _format_labels(self.labelnames, labelvalues, ('le', _format_value(bound))) + ' ' + str(cumulative))
+                lines.append(self.name + '_sum' + _format_labels(self.labelnames, labelvalues) + ' ' + _format_value(total))
+                lines.append(self.name + '_count' + _format_labels(self.labelnames, labelvalues) + ' ' + str(count))
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelvalues)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = list()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = list()
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        # Replaced as a whole, so the collector never reads a partial file
+        write_atomic(path, self.render().encode('utf-8'))
+
+    def serve(self, port, address=''):
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((address, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        return server
+
+
+REGISTRY = Registry()
+
+# Metrics of the scrape pipeline
+vcenter_calls = REGISTRY.register(Counter('vsphere_datascraper_vcenter_calls', 'Calls made to vCenter.', ('vcenter', 'method')))
+vcenter_call_seconds = REGISTRY.register(Histogram('vsphere_datascraper_vcenter_call_seconds', 'Duration of calls made to vCenter.', ('vcenter', 'method')))
+vcenter_concurrency_limit = REGISTRY.register(Gauge('vsphere_datascraper_vcenter_concurrency_limit', 'Current limit of concurrent calls to vCenter, lowered while vCenter responds slowly.', ('vcenter',)))
+vms_collected = REGISTRY.register(Counter('vsphere_datascraper_vms_collected', 'VMs collected from vCenter.', ('vcenter',)))
+vm_errors = REGISTRY.register(Counter('vsphere_datascraper_vm_errors', 'VMs that could not be collected.', ('vcenter',)))
+vms_published = REGISTRY.register(Counter('vsphere_datascraper_vms_published', 'VM records and removal events passed to the outputs.'))
+output_seconds = REGISTRY.register(Histogram('vsphere_datascraper_output_seconds', 'Time an output spent on one batch of VMs.', ('output',)))
+output_flush_seconds = REGISTRY.register(Histogram('vsphere_datascraper_output_flush_seconds', 'Time an output spent flushing.', ('output',)))
+output_errors = REGISTRY.register(Counter('vsphere_datascraper_output_errors', 'VMs an output failed to process.', ('output',)))
+output_queue_depth = REGISTRY.register(Gauge('vsphere_datascraper_output_queue_depth', 'VMs waiting in the queue of an output.', ('output',)))
+output_messages = REGISTRY.register(Gauge('vsphere_datascraper_output_messages', 'Documents or messages handled by Elasticsearch and Kafka outputs, by result.', ('output', 'destination', 'result')))
+run_duration_seconds = REGISTRY.register(Gauge('vsphere_datascraper_run_duration_seconds', 'Duration of the last one-shot run, or the uptime in watch mode.'))
+last_success_seconds = REGISTRY.register(Gauge('vsphere_datascraper_last_success_timestamp_seconds', 'Time the last run or watch round completed.'))
+
+def timed_call(vcenter, method, function, *args):
+    # Calls a vCenter method and records the call
+    vcenter_calls.inc(1, vcenter, method)
+    with vcenter_call_seconds.time(vcenter, method):
+        return function(*args)
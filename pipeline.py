@@ -0,0 +1,222 @@
+import asyncio
+import collections
+import inspect
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import output_seconds, output_flush_seconds, output_errors, output_queue_depth
+
+# Queue markers
+_STOP = object()
+_FLUSH = object()
+
+class Stage:
+    # Feeds one sink. VMs are gathered into batches of batch_size, a batch is emitted early once its first
+    # VM has waited batch_timeout seconds. Blocking sink methods run in threads of this stage only.
+    def __init__(self, sink, queue_size=1000, batch_size=None, batch_timeout=None):
+        self.sink = sink
+        self.name = sink.name
+        self.batch_size = max(batch_size or sink.batch_size, 1)
+        self.batch_timeout = sink.batch_timeout if batch_timeout is None else batch_timeout
+        self.workers = max(sink.workers, 1)
+        # Free places in the queue, put() blocks on it when the sink falls behind
+        self.free = threading.Semaphore(queue_size)
+        # Items put from other threads wait here until the event loop moves them into the queue. The loop is
+        # woken up once for all items waiting, not for every item.
+        self.incoming = collections.deque()
+        self.incoming_lock = threading.Lock()
+        self.wakeup = False
+        self.queue = None
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+        self.task = None
+        self.processed = 0
+        self.errors = 0
+        # VMs of the batches the sink raised on
+        self.failed = list()
+        output_queue_depth.set_function(lambda: len(self.incoming) + (self.queue.qsize() if self.queue is not None else 0), self.name)
+
+    def put(self, loop, item):
+        self.free.acquire()
+        with self.incoming_lock:
+            self.incoming.append(item)
+            if self.wakeup:
+                return
+            self.wakeup = True
+        loop.call_soon_threadsafe(self.receive)
+
+    def receive(self):
+        with self.incoming_lock:
+            items, self.incoming = self.incoming, collections.deque()
+            self.wakeup = False
+        for item in items:
+            self.queue.put_nowait(item)
+
+    async def call(self, function, *args):
+        if inspect.iscoroutinefunction(function):
+            return await function(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.workers)
+        emitting = set()
+        batch = list()
+        deadline = None
+        getter = None
+
+        while True:
+            # The pending get is kept over timeouts, cancelling it could lose an item
+            if getter is None:
+                getter = asyncio.ensure_future(self.queue.get())
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({getter}, timeout=timeout)
+            if not done:
+                await self.emit(batch, slots, emitting)
+                batch, deadline = list(), None
+                continue
+            items, getter = [getter.result()], None
+            # Everything already queued is taken at once, waiting on the queue per item is slow
+            while not self.queue.empty():
+                items.append(self.queue.get_nowait())
+
+            for item in items:
+                if item is _STOP or (isinstance(item, tuple) and item[0] is _FLUSH):
+                    await self.emit(batch, slots, emitting)
+                    batch, deadline = list(), None
+                    if emitting:
+                        await asyncio.wait(emitting)
+                    if item is _STOP:
+                        return
+                    await self.flush()
+                    item[1].set_result(None)
+                    continue
+
+                self.free.release()
+                batch.append(item)
+                if deadline is None:
+                    deadline = loop.time() + self.batch_timeout
+                if len(batch) >= self.batch_size:
+                    await self.emit(batch, slots, emitting)
+                    batch, deadline = list(), None
+
+    async def emit(self, batch, slots, emitting):
+        # Waits for a free slot only, the batch is emitted while the next one is gathered
+        if not batch:
+            return
+        await slots.acquire()
+        task = asyncio.ensure_future(self.emit_batch(batch, slots))
+        emitting.add(task)
+        task.add_done_callback(emitting.discard)
+
+    async def emit_batch(self, batch, slots):
+        try:
+            start = time.perf_counter()
+            await self.call(self.sink.emit_batch, batch)
+            output_seconds.observe(time.perf_counter() - start, self.name)
+            self.processed += len(batch)
+        except Exception as e:
+            self.errors += len(batch)
+            self.failed.extend(batch)
+            output_errors.inc(len(batch), self.name)
+            print('Error occurred in ' + self.name + ': ', e)
+        finally:
+            slots.release()
+
+    async def flush(self):
+        try:
+            with output_flush_seconds.time(self.name):
+                await self.call(self.sink.flush)
+        except Exception as e:
+            output_errors.inc(1, self.name)
+            print('Error occurred in ' + self.name + ': ', e)
+
+    def take_failed(self):
+        # VMs of the batches the sink raised on and VMs the sink reports as not delivered, since the last call
+        failed, self.failed = self.failed, list()
+        return failed + self.sink.take_failed()
+
+    async def close(self):
+        try:
+            await self.call(self.sink.close)
+        except Exception as e:
+            print('Error occurred in ' + self.name + ': ', e)
+        self.executor.shutdown()
+
+
+class Pipeline:
+    # Connects the collection side to the sinks. Every item put into the pipeline is passed to every sink.
+    # The sinks are driven by an asyncio event loop in a thread of its own. Sink queues are bounded, so
+    # put() blocks when a sink falls behind.
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self.stages = list()
+        self.loop = None
+        self.thread = None
+
+    def add_sink(self, sink, batch_size=None, batch_timeout=None):
+        self.stages.append(Stage(sink, self.queue_size, batch_size=batch_size, batch_timeout=batch_timeout))
+
+    def start(self):
+        # Opens the sinks, errors (e.g. an unreachable server) are raised here
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='pipeline', daemon=True)
+        self.thread.start()
+        self.run(self._start())
+
+    async def _start(self):
+        for stage in self.stages:
+            stage.queue = asyncio.Queue()
+        await asyncio.gather(*[stage.call(stage.sink.open) for stage in self.stages])
+        for stage in self.stages:
+            stage.task = asyncio.ensure_future(stage.run())
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def put(self, item, stages=None):
+        # stages optionally limits the item to the stages with the given names
+        for stage in self.stages:
+            if stages is None or stage.name in stages:
+                stage.put(self.loop, item)
+
+    def flush(self):
+        # Blocks until every sink has emitted all items put so far and has been flushed
+        self.run(self._flush())
+
+    async def _flush(self):
+        flushed = list()
+        for stage in self.stages:
+            # Items put before the flush are still on their way
+            stage.receive()
+            future = asyncio.get_running_loop().create_future()
+            stage.queue.put_nowait((_FLUSH, future))
+            flushed.append(future)
+        await asyncio.gather(*flushed)
+
+    def close(self):
+        self.flush()
+        self.run(self._close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def _close(self):
+        for stage in self.stages:
+            stage.receive()
+            stage.queue.put_nowait(_STOP)
+        await asyncio.gather(*[stage.task for stage in self.stages])
+        await asyncio.gather(*[stage.close() for stage in self.stages])
+
+    def take_failed(self, stages=None):
+        # Returns the VMs the given stages failed to deliver since the last call, call it after flush(). The
+        # failures of the other stages are dropped.
+        failed = list()
+        for stage in self.stages:
+            stage_failed = stage.take_failed()
+            if stages is None or stage.name in stages:
+                failed.extend(stage_failed)
+        return failed
+
+    def report(self):
+        for stage in self.stages:
+            print('Stage ' + stage.name + ': processed ' + str(stage.processed) + ', errors ' + str(stage.errors))
@@ -0,0 +1,99 @@
+import threading
+import time
+from metrics import vcenter_concurrency_limit
+
+# Keeps the load a scrape puts on a vCenter in check. All calls of the targets on one vCenter share a
+# Scheduler: a token bucket caps the request rate, and an AIMD controller adapts the number of concurrent
+# calls to the response latency of the vCenter.
+
+class TokenBucket:
+    # rate tokens per second, up to burst tokens are saved while idle. A rate of 0 disables the limit.
+    def __init__(self, rate=0, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        if not self.rate:
+            return
+        tokens = min(tokens, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Tokens are taken right away, a caller going into debt sleeps until it is paid off. Callers are
+            # served in the order they arrive.
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AdaptiveLimiter:
+    # Additive increase, multiplicative decrease of the concurrency limit. The latency of every call is
+    # compared to the lowest latency seen for that method, the baseline. Calls slower than tolerance times
+    # the baseline mean the vCenter is busy and the limit is cut by backoff, otherwise it grows by one
+    # call per window of limit calls.
+    def __init__(self, max_limit=8, min_limit=1, tolerance=2.0, backoff=0.7):
+        self.max_limit = max(max_limit, 1)
+        self.min_limit = max(min(min_limit, self.max_limit), 1)
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.limit = float(self.min_limit)
+        self.in_flight = 0
+        self.baselines = dict()
+        self.decreased = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, method, latency):
+        with self.condition:
+            self.in_flight -= 1
+            baseline = self.baselines.get(method)
+            if baseline is None or latency < baseline:
+                baseline = latency
+            else:
+                # Drifts up slowly, so the baseline follows lasting changes (e.g. a bigger inventory)
+                baseline += (latency - baseline) * 0.001
+            self.baselines[method] = baseline
+
+            now = time.monotonic()
+            if latency > self.tolerance * baseline:
+                # Calls started before the last cut still report the old load, they do not cut again
+                if now - self.decreased > latency:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self.decreased = now
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class Scheduler:
+    def __init__(self, host='', rate=0, burst=None, max_concurrency=8, latency_tolerance=2.0):
+        self.bucket = TokenBucket(rate, burst)
+        self.limiter = AdaptiveLimiter(max_limit=max_concurrency, tolerance=latency_tolerance)
+        self.max_concurrency = max_concurrency
+        self.local = threading.local()
+        vcenter_concurrency_limit.set_function(lambda: int(self.limiter.limit), host)
+
+    def call(self, method, function, tokens=1):
+        # tokens: number of requests the call makes, e.g. the properties read from a VM one by one
+        self.bucket.acquire(tokens)
+        # Calls made within a call (e.g. name lookups while reading a VM) run in the slot of the outer call
+        if getattr(self.local, 'active', False):
+            return function()
+        self.limiter.acquire()
+        self.local.active = True
+        start = time.perf_counter()
+        try:
+            return function()
+        finally:
+            self.local.active = False
+            self.limiter.release(method, time.perf_counter() - start)
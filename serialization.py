@@ -0,0 +1,100 @@
+import json
+
+# Optional fast JSON backends, the standard library is used when none of them is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+BACKENDS = ['auto', 'orjson', 'ujson', 'json']
+
+# One encoder function per backend, records cache their encoding per encoder function
+_encoders = dict()
+
+def get_json_encoder(backend='auto'):
+    # Returns a function serializing an object into compact UTF-8 JSON bytes
+    if backend not in _encoders:
+        _encoders[backend] = _create_json_encoder(backend)
+    return _encoders[backend]
+
+def _create_json_encoder(backend):
+    if backend == 'auto':
+        backend = 'orjson' if orjson is not None else 'ujson' if ujson is not None else 'json'
+
+    if backend == 'orjson':
+        if orjson is None:
+            raise ImportError('orjson is not installed (pip3 install orjson)')
+        return orjson.dumps
+    if backend == 'ujson':
+        if ujson is None:
+            raise ImportError('ujson is not installed (pip3 install ujson)')
+        return lambda obj: ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+    if backend == 'json':
+        return lambda obj: json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    raise ValueError('Unknown JSON backend ' + str(backend))
+
+def encode_default(obj):
+    # The JSON of the json file format and of Kafka messages
+    return json.dumps(obj, default=str).encode('utf-8')
+
+
+class Record(dict):
+    # A VM as collected. Outputs serialize it with encode(), every encoding is done once per record and
+    # shared by all outputs using the same encoder. Changing a key drops the cached encodings; nested
+    # values (NIC lists, ...) must not be changed once the record has been passed to the outputs.
+    __slots__ = ('_encoded',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._encoded = None
+
+    def encode(self, encoder=encode_default):
+        encoded = self._encoded
+        if encoded is None:
+            encoded = self._encoded = dict()
+        data = encoded.get(encoder)
+        if data is None:
+            data = encoded[encoder] = encoder(self)
+        return data
+
+    def __setitem__(self, key, value):
+        self._encoded = None
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._encoded = None
+        super().__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        self._encoded = None
+        super().update(*args, **kwargs)
+
+    def pop(self, *args):
+        self._encoded = None
+        return super().pop(*args)
+
+    def setdefault(self, key, default=None):
+        self._encoded = None
+        return super().setdefault(key, default)
+
+    def popitem(self):
+        self._encoded = None
+        return super().popitem()
+
+    def clear(self):
+        self._encoded = None
+        super().clear()
+
+    def __reduce__(self):
+        # Pickles (e.g. deepcopy) as a plain record, without the cached encodings
+        return (Record, (dict(self),))
+
+def encode(info, encoder=encode_default):
+    # Serializes a record once, or any other dict every time
+    if isinstance(info, Record):
+        return info.encode(encoder)
+    return encoder(info)
@@ -0,0 +1,37 @@
+import json
+import os
+import threading
+
+# Targets connect from several threads, the file is read and written as a whole
+_lock = threading.Lock()
+
+class SessionCache:
+    # Stores vCenter session cookies between runs, keyed by user@host:port. The cookies grant access to
+    # vCenter as that user, so the file is only readable by its owner.
+    def __init__(self, path):
+        self.path = path
+
+    def get_key(host, port, user):
+        return user + '@' + host + ':' + str(port)
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return dict()
+
+    def get(self, key):
+        with _lock:
+            return self.load().get(key)
+
+    def set(self, key, cookie):
+        with _lock:
+            sessions = self.load()
+            if cookie is None:
+                sessions.pop(key, None)
+            else:
+                sessions[key] = cookie
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as file:
+                json.dump(sessions, file)
@@ -0,0 +1,505 @@
+import metrics
+
+# Outputs of the scraper. The pipeline passes the collected VMs to every enabled sink in batches:
+#   open()                before the first batch
+#   emit_batch(vm_infos)  for every batch, a list of VM dicts. May also be a coroutine function.
+#   flush()               when everything emitted so far has to be delivered (end of run, watch rounds)
+#   close()               once at the end
+#   take_failed()         VMs that could not be delivered since the last call
+# Blocking methods run in threads of their own sink, so a slow sink does not hold up the others.
+#
+# Sinks are looked up in SINKS and in the "vsphere_datascraper.sinks" entry point group, so outputs
+# installed as separate packages need no changes here or in main.py. A sink class can add command line
+# arguments in add_arguments(parser) and reject invalid ones with parser.error() in
+# check_arguments(parser, args). It is created with from_args(args) when enabled(args) is true.
+
+ENTRY_POINT_GROUP = 'vsphere_datascraper.sinks'
+
+def track(inventory, vm_info):
+    # Keeps the current inventory in watch mode, where only changes are received
+    key = (vm_info.get('vcenter'), vm_info.get('datacenter'), vm_info.get('instance_uuid') or vm_info.get('name'))
+    if vm_info.get('removed'):
+        inventory.pop(key, None)
+    else:
+        inventory[key] = vm_info
+
+
+class Sink:
+    name = None
+    # Sinks that always reflect the whole inventory get every VM, even with --changes-only
+    inventory = False
+    # Defaults, --batch-size and --batch-timeout override them per sink
+    batch_size = 500
+    batch_timeout = 1.0
+
+    def __init__(self, workers=1):
+        # Number of batches emitted at the same time
+        self.workers = workers
+
+    def add_arguments(parser):
+        pass
+
+    def check_arguments(parser, args):
+        pass
+
+    def enabled(args):
+        return False
+
+    def open(self):
+        pass
+
+    def emit_batch(self, vm_infos):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def take_failed(self):
+        # VMs that could not be delivered since the last call. With --changes-only their changes are not
+        # recorded as published, so they are published again.
+        return list()
+
+
+class ElasticsearchSink(Sink):
+    name = 'elasticsearch'
+
+    def __init__(self, ela_fanout, workers=1, verbose=False):
+        super().__init__(workers)
+        self.ela_fanout = ela_fanout
+        self.verbose = verbose
+
+    def enabled(args):
+        return bool(args.es_hosts)
+
+    def from_args(args):
+        from elastic_link import ElasticLink, ElasticFanout
+
+        ela_links = list()
+        for es_host in args.es_hosts:
+            if args.verbose:
+                print('Connecting to ES host: ' + str(es_host))
+            ela_links.append(ElasticLink(ela_host=es_host,
+                                         ela_index=args.index,
+                                         op_type=args.es_op_type,
+                                         flush_docs=args.es_flush_docs,
+                                         flush_bytes=args.es_flush_bytes,
+                                         flush_interval=args.es_flush_interval,
+                                         thread_count=args.es_threads,
+                                         chunk_size=args.es_chunk_size,
+                                         max_retries=args.es_max_retries,
+                                         verbose=args.verbose))
+        return ElasticsearchSink(ElasticFanout(ela_links, workers=args.es_workers),
+                                 workers=args.es_workers,
+                                 verbose=args.verbose)
+
+    def open(self):
+        self.ela_fanout.connect()
+        for ela_link in self.ela_fanout.ela_links:
+            for result in ('pushed', 'failed', 'retried'):
+                metrics.output_messages.set_function(lambda ela_link=ela_link, result=result: getattr(ela_link, result),
+                                                     self.name, str(ela_link.ela_host), result)
+
+    def emit_batch(self, vm_infos):
+        for vm_info in vm_infos:
+            self.ela_fanout.append(vm_info)
+
+    def flush(self):
+        self.ela_fanout.flush()
+
+    def close(self):
+        self.ela_fanout.close()
+        if self.verbose:
+            self.ela_fanout.report()
+
+    def take_failed(self):
+        return [vm_info for ela_link in self.ela_fanout.ela_links for vm_info in ela_link.take_failed()]
+
+
+class KafkaSink(Sink):
+    name = 'kafka'
+
+    def __init__(self, kafka_link, workers=1, verbose=False):
+        super().__init__(workers)
+        self.kafka_link = kafka_link
+        self.verbose = verbose
+
+    def enabled(args):
+        return bool(args.kafka_host)
+
+    def from_args(args):
+        from kafka_link import KafkaLink
+
+        return KafkaSink(KafkaLink(kafka_host=args.kafka_host,
+                                   kafka_topic=args.kafka_topic,
+                                   kafka_compression=args.kafka_compression,
+                                   ip_split=args.ip_split,
+                                   linger_ms=args.kafka_linger_ms,
+                                   batch_size=args.kafka_batch_size,
+                                   buffer_memory=args.kafka_buffer_memory,
+                                   acks=args.kafka_acks if args.kafka_acks == 'all' else int(args.kafka_acks),
+                                   max_in_flight=args.kafka_max_in_flight,
+                                   verbose=args.verbose),
+                         workers=args.kafka_workers,
+                         verbose=args.verbose)
+
+    def open(self):
+        if self.verbose:
+            print('Connecting to Kafka hosts: ' + str(self.kafka_link.kafka_host))
+        self.kafka_link.connect()
+        for result in ('delivered', 'failed'):
+            metrics.output_messages.set_function(lambda result=result: getattr(self.kafka_link, result),
+                                                 self.name, str(self.kafka_link.kafka_topic), result)
+
+    def emit_batch(self, vm_infos):
+        for vm_info in vm_infos:
+            self.kafka_link.push_to_server(vm_info)
+
+    def flush(self):
+        self.kafka_link.flush()
+
+    def close(self):
+        self.kafka_link.close()
+        if self.verbose:
+            self.kafka_link.report()
+
+    def take_failed(self):
+        return self.kafka_link.take_failed()
+
+
+class FileSink(Sink):
+    name = 'file'
+    batch_size = 1000
+
+    def __init__(self, file_link):
+        super().__init__()
+        self.file_link = file_link
+
+    def enabled(args):
+        return bool(args.file_path)
+
+    def from_args(args):
+        from file_link import FileLink
+
+        if args.verbose:
+            print('Opening ' + args.file_path + ' for writing.')
+        return FileSink(FileLink(file_path=args.file_path,
+                                 file_format=args.file_format,
+                                 compression=args.file_compression,
+                                 rotate_bytes=args.file_rotate_bytes,
+                                 rotate_count=args.file_rotate_count,
+                                 json_backend=args.json_backend))
+
+    def emit_batch(self, vm_infos):
+        for vm_info in vm_infos:
+            self.file_link.write(vm_info)
+
+    def flush(self):
+        self.file_link.flush()
+
+    def close(self):
+        self.file_link.close()
+
+
+class ColumnarSink(Sink):
+    # Parquet or Arrow tables of the VMs and their IPs for analytics, one file per table and run.
+    # Snapshots are always complete, even with --changes-only.
+    name = 'columnar'
+    inventory = True
+    batch_size = 1000
+
+    def __init__(self, columnar_link):
+        super().__init__()
+        self.columnar_link = columnar_link
+
+    def add_arguments(parser):
+        parser.add_argument('--columnar-dir',
+                            dest='columnar_dir',
+                            help='Write the VMs and their IPs as tables to DIR/vms/ and DIR/ips/, one file per run named after its start time. Needs pyarrow.')
+        parser.add_argument('--columnar-format',
+                            dest='columnar_format',
+                            default='parquet',
+                            choices=['parquet', 'arrow'],
+                            help='File format of the tables, "arrow" writes Arrow IPC streams (.arrows, read with pyarrow.ipc.open_stream). Default: parquet')
+        parser.add_argument('--columnar-compression',
+                            dest='columnar_compression',
+                            default='zstd',
+                            choices=['zstd', 'snappy', 'gzip', 'lz4', 'none'],
+                            help='Compression of the tables. Arrow files support zstd and lz4 only. Default: zstd')
+        parser.add_argument('--columnar-row-group-size',
+                            dest='columnar_row_group_size',
+                            type=int,
+                            default=65536,
+                            help='Number of rows written at once as a row group (a record batch in Arrow files). Smaller row groups use less memory. Default: 65536')
+
+    def enabled(args):
+        return bool(args.columnar_dir)
+
+    def from_args(args):
+        from columnar_link import ColumnarLink
+
+        if args.verbose:
+            print('Writing tables to ' + args.columnar_dir)
+        return ColumnarSink(ColumnarLink(directory=args.columnar_dir,
+                                         file_format=args.columnar_format,
+                                         compression=None if args.columnar_compression == 'none' else args.columnar_compression,
+                                         row_group_size=args.columnar_row_group_size))
+
+    def emit_batch(self, vm_infos):
+        for vm_info in vm_infos:
+            self.columnar_link.write(vm_info)
+
+    def flush(self):
+        self.columnar_link.flush()
+
+    def close(self):
+        self.columnar_link.close()
+
+
+class WiseSink(Sink):
+    name = 'wise'
+    inventory = True
+    batch_size = 1000
+
+    def __init__(self, wise_link, watch=False):
+        super().__init__()
+        self.wise_link = wise_link
+        # The WISE dump always reflects the whole current inventory, in watch mode it is rewritten every round
+        self.watch = watch
+        self.vm_inventory = dict()
+
+    def enabled(args):
+        return bool(args.wise_path)
+
+    def from_args(args):
+        from wise_link import WiseLink
+
+        if args.verbose:
+            print('Opening ' + args.wise_path + ' for writing.')
+        return WiseSink(WiseLink(file_path=args.wise_path,
+                                 wise_full_mode=args.wise_full_mode,
+                                 wise_format=args.wise_format,
+                                 compress=args.wise_gzip),
+                        watch=args.watch)
+
+    def emit_batch(self, vm_infos):
+        for vm_info in vm_infos:
+            if self.watch:
+                track(self.vm_inventory, vm_info)
+            else:
+                self.wise_link.append(vm_info)
+
+    def flush(self):
+        if self.watch:
+            self.wise_link.rewrite(self.vm_inventory.values())
+
+    def close(self):
+        if not self.watch:
+            self.wise_link.write()
+
+
+class StdoutSink(Sink):
+    name = 'stdout'
+    batch_size = 1
+
+    def __init__(self, pretty=False):
+        super().__init__()
+        if pretty:
+            import pprint
+            self.print = pprint.PrettyPrinter(indent=2).pprint
+        else:
+            self.print = print
+
+    def enabled(args):
+        return args.stdout
+
+    def from_args(args):
+        return StdoutSink(pretty=args.stdout_pretty)
+
+    def emit_batch(self, vm_infos):
+        for vm_info in vm_infos:
+            self.print(vm_info)
+
+
+class DuplicatesSink(Sink):
+    name = 'duplicates'
+    inventory = True
+    batch_size = 1000
+
+    def __init__(self, mode, report_path=None, report_format='json', watch=False):
+        super().__init__()
+        self.mode = mode
+        self.report_path = report_path
+        self.report_format = report_format
+        # In watch mode the duplicates of the whole current inventory are reported every round
+        self.watch = watch
+        self.vm_inventory = dict()
+
+    def enabled(args):
+        return args.duplicate_detection
+
+    def from_args(args):
+        return DuplicatesSink(mode=args.duplicate_mode,
+                              report_path=args.duplicate_report,
+                              report_format=args.duplicate_report_format,
+                              watch=args.watch)
+
+    def open(self):
+        from duplicate_detection import DuplicateDetection
+
+        self.dupl = DuplicateDetection(mode=self.mode)
+
+    def emit_batch(self, vm_infos):
+        for vm_info in vm_infos:
+            if self.watch:
+                track(self.vm_inventory, vm_info)
+            else:
+                self.dupl.find_duplicates(vm_info)
+
+    def flush(self):
+        if self.watch:
+            from duplicate_detection import DuplicateDetection
+
+            self.dupl = DuplicateDetection(mode=self.mode)
+            for vm_info in self.vm_inventory.values():
+                self.dupl.find_duplicates(vm_info)
+            self.report()
+
+    def close(self):
+        if not self.watch:
+            self.report()
+
+    def report(self):
+        self.dupl.print_duplicates()
+        if self.report_path:
+            self.dupl.write_report(self.report_path, self.report_format)
+
+
+class EnrichmentSink(Sink):
+    # IP and MAC lookup index of the VMs, written to a file and/or served over HTTP in watch mode
+    name = 'enrichment'
+    inventory = True
+    batch_size = 1000
+
+    def __init__(self, index_path=None, port=None, address='127.0.0.1', watch=False):
+        super().__init__()
+        self.index_path = index_path
+        self.port = port
+        self.address = address
+        self.watch = watch
+        self.vm_inventory = dict()
+        self.builder = None
+        self.server = None
+
+    def add_arguments(parser):
+        parser.add_argument('--enrichment-index',
+                            dest='enrichment_index',
+                            help='Write an IP and MAC lookup index of the VMs to this file. Serve it with "enrichment_index.py FILE" as a JSON lookup API.')
+        parser.add_argument('--enrichment-port',
+                            dest='enrichment_port',
+                            type=int,
+                            help='In watch mode, serve JSON lookups of the current inventory on this port, e.g. GET /ip/10.0.0.1 or GET /mac/00:50:56:00:00:01. '
+                                 'This is not the Arkime wiseService protocol, use --wise for a wiseService file source.')
+        parser.add_argument('--enrichment-address',
+                            dest='enrichment_address',
+                            default='127.0.0.1',
+                            help='Address to serve enrichment lookups on. Default: 127.0.0.1')
+
+    def check_arguments(parser, args):
+        if args.enrichment_port and not args.watch:
+            parser.error('--enrichment-port needs --watch, use --enrichment-index to write the index of a single run')
+
+    def enabled(args):
+        return bool(args.enrichment_index or (args.enrichment_port and args.watch))
+
+    def from_args(args):
+        return EnrichmentSink(index_path=args.enrichment_index,
+                              port=args.enrichment_port if args.watch else None,
+                              address=args.enrichment_address,
+                              watch=args.watch)
+
+    def open(self):
+        from enrichment_index import IndexBuilder
+
+        self.builder = IndexBuilder()
+
+    def emit_batch(self, vm_infos):
+        for vm_info in vm_infos:
+            if self.watch:
+                track(self.vm_inventory, vm_info)
+            else:
+                self.builder.add(vm_info)
+
+    def flush(self):
+        # In watch mode the index is rebuilt from the current inventory every round
+        if self.watch:
+            from enrichment_index import IndexBuilder
+
+            builder = IndexBuilder()
+            for vm_info in self.vm_inventory.values():
+                builder.add(vm_info)
+            self.publish(builder)
+
+    def close(self):
+        if not self.watch:
+            self.publish(self.builder)
+        if self.server is not None:
+            self.server.close()
+
+    def publish(self, builder):
+        from enrichment_index import EnrichmentIndex, EnrichmentServer
+
+        if self.index_path:
+            builder.write(self.index_path)
+        if self.port:
+            index = EnrichmentIndex(builder.build())
+            if self.server is None:
+                self.server = EnrichmentServer(index, self.port, self.address)
+            else:
+                self.server.index = index
+
+
+# Built-in sinks, in the order they are fed
+SINKS = {sink_class.name: sink_class for sink_class in
+         (ElasticsearchSink, KafkaSink, FileSink, ColumnarSink, WiseSink, StdoutSink, DuplicatesSink, EnrichmentSink)}
+
+def get_sink_classes():
+    # Built-in sinks plus the sinks of installed packages, e.g. in a package's pyproject.toml:
+    #   [project.entry-points."vsphere_datascraper.sinks"]
+    #   webhook = "my_package.webhook:WebhookSink"
+    sink_classes = dict(SINKS)
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return sink_classes
+
+    found = entry_points()
+    if hasattr(found, 'select'):
+        found = found.select(group=ENTRY_POINT_GROUP)
+    else:
+        found = found.get(ENTRY_POINT_GROUP, [])
+    for entry_point in found:
+        if entry_point.name in sink_classes:
+            print('Ignoring sink ' + entry_point.name + ' of ' + entry_point.value + ', the name is taken')
+            continue
+        try:
+            sink_class = entry_point.load()
+        except Exception as e:
+            print('Unable to load sink ' + entry_point.name + ': ', e)
+            continue
+        if sink_class.name is None:
+            sink_class.name = entry_point.name
+        sink_classes[entry_point.name] = sink_class
+    return sink_classes
+
+def parse_sink_options(values, convert, option):
+    # Parses "sink=value" pairs, e.g. --batch-size elasticsearch=1000 file=5000
+    options = dict()
+    for value in values or []:
+        name, separator, setting = value.partition('=')
+        if not separator:
+            raise ValueError(option + ' expects OUTPUT=VALUE, got ' + value)
+        options[name] = convert(setting)
+    return options
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import sqlite3
+from datetime import datetime
+from serialization import Record, encode
+
+class SnapshotStore:
+    # Remembers a content hash of the last published record of every VM between runs, so unchanged VMs
+    # can be skipped and deleted VMs detected. Changes are only written to disk by commit().
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS vms ('
+                        'key TEXT PRIMARY KEY, '
+                        'vcenter TEXT, '
+                        'datacenter TEXT, '
+                        'hash TEXT, '
+                        'record TEXT, '
+                        'updated TEXT)')
+        self.db.commit()
+        self.hashes = dict(self.db.execute('SELECT key, hash FROM vms'))
+        # Hashes as last committed, for rolling back
+        self.stored = dict(self.hashes)
+        self.seen = set()
+        self.updates = dict()
+        self.deletes = set()
+
+    def get_key(vm_info):
+        return '/'.join([str(vm_info.get('vcenter')),
+                         str(vm_info.get('datacenter')),
+                         str(vm_info.get('instance_uuid') or vm_info.get('name'))])
+
+    def get_hash(vm_info):
+        # The timestamp changes on every scrape and is left out
+        content = {k: v for k, v in vm_info.items() if k != 'ts'}
+        return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def check(self, vm_info):
+        # Returns True when the VM is new or changed since it was last published
+        key = SnapshotStore.get_key(vm_info)
+        if vm_info.get('removed'):
+            self.remove(key)
+            return True
+
+        self.seen.add(key)
+        content_hash = SnapshotStore.get_hash(vm_info)
+        if self.hashes.get(key) == content_hash:
+            return False
+        self.hashes[key] = content_hash
+        self.updates[key] = (vm_info.get('vcenter'), vm_info.get('datacenter'), content_hash, encode(vm_info).decode('utf-8'), vm_info.get('ts'))
+        self.deletes.discard(key)
+        return True
+
+    def remove(self, key):
+        self.hashes.pop(key, None)
+        self.updates.pop(key, None)
+        self.deletes.add(key)
+
+    def tombstones(self, completed):
+        # Yields removal events for stored VMs of the completed (vcenter, datacenter) targets not seen in this run.
+        # Targets that failed must not be in completed, otherwise all their VMs would be reported deleted.
+        rows = self.db.execute('SELECT key, vcenter, datacenter, record FROM vms').fetchall()
+        for key, vcenter, datacenter, record in rows:
+            if key in self.seen or key in self.deletes or (vcenter, datacenter) not in completed:
+                continue
+            vm_info = Record(json.loads(record))
+            vm_info['ts'] = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f') + 'Z'
+            vm_info['removed'] = True
+            self.remove(key)
+            yield vm_info
+
+    def commit(self):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO vms (key, vcenter, datacenter, hash, record, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                                [(key,) + update for key, update in self.updates.items()])
+            self.db.executemany('DELETE FROM vms WHERE key = ?', [(key,) for key in self.deletes])
+        for key, update in self.updates.items():
+            self.stored[key] = update[2]
+        for key in self.deletes:
+            self.stored.pop(key, None)
+        self.updates = dict()
+        self.deletes = set()
+
+    def rollback(self, keys=None):
+        # Forgets the changes of the VMs with the given keys (all by default) since the last commit, e.g.
+        # when an output failed to deliver them. The VMs are then published again by the next run or watch
+        # round they are seen in.
+        if keys is None:
+            keys = set(self.updates) | self.deletes
+        for key in keys:
+            if key not in self.updates and key not in self.deletes:
+                continue
+            if key in self.stored:
+                self.hashes[key] = self.stored[key]
+            else:
+                self.hashes.pop(key, None)
+            self.updates.pop(key, None)
+            self.deletes.discard(key)
+
+    def close(self):
+        self.db.close()
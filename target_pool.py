@@ -0,0 +1,129 @@
+import queue
+import threading
+from getpass import getpass
+from vm_vcenter import VMvCenter
+from scheduler import Scheduler
+
+# Marks the end of the results of one target
+_DONE = object()
+
+def load_targets(path, defaults):
+    # Reads a YAML (or JSON) file with a list of targets, either at the top level or under "targets".
+    # Keys: vhost, vport, user, password, password_file, disable_ssl_verification, datacenter, folder, exclude.
+    # folder is one path or a list of paths, exclude a list of folder path patterns.
+    # Missing keys are taken from defaults.
+    import yaml
+
+    with open(path, 'r') as file:
+        config = yaml.safe_load(file)
+    if isinstance(config, dict):
+        config = config.get('targets', [])
+
+    targets = list()
+    for entry in config:
+        target = dict(defaults)
+        target.update({k: v for k, v in entry.items() if v is not None})
+        # A password given in the entry replaces the one inherited from the command line, either way
+        if entry.get('password_file') and not entry.get('password'):
+            target['password'] = None
+        if entry.get('password') and not entry.get('password_file'):
+            target['password_file'] = None
+        for key in ('vhost', 'user', 'folder'):
+            if not target.get(key):
+                raise ValueError('Target ' + str(entry) + ' in ' + path + ' is missing "' + key + '"')
+        targets.append(target)
+    return targets
+
+def build_vcenters(targets, field_set=None, session_cache=None, keepalive=0, rate_limit=0, rate_burst=None,
+                   max_concurrency=8, latency_tolerance=2.0, prioritize=False):
+    # Creates one VMvCenter per target. Passwords are asked once per vhost and user, the targets on one
+    # vhost share its rate and concurrency limit.
+    passwords = dict()
+    schedulers = dict()
+    vcenters = list()
+    for target in targets:
+        # As with the command line arguments, a password file takes precedence over a password
+        password = target.get('password')
+        if target.get('password_file'):
+            with open(target['password_file'], 'r') as file:
+                password = file.read().replace('\n', '')
+        if not password:
+            key = (target['vhost'], target['user'])
+            if key not in passwords:
+                passwords[key] = getpass(
+                    prompt='Please enter password for host %s and user %s: '
+                           % key)
+            password = passwords[key]
+
+        if target['vhost'] not in schedulers:
+            schedulers[target['vhost']] = Scheduler(host=target['vhost'],
+                                                    rate=rate_limit,
+                                                    burst=rate_burst,
+                                                    max_concurrency=max_concurrency,
+                                                    latency_tolerance=latency_tolerance)
+
+        vcenters.append(VMvCenter(host=target['vhost'],
+                                  user=target['user'],
+                                  password=password,
+                                  port=target.get('vport', 443),
+                                  disable_ssl_verification=target.get('disable_ssl_verification', False),
+                                  folder_path=target['folder'],
+                                  datacenter=target.get('datacenter'),
+                                  exclude=target.get('exclude'),
+                                  field_set=field_set,
+                                  session_cache=session_cache,
+                                  keepalive=keepalive,
+                                  scheduler=schedulers[target['vhost']],
+                                  prioritize=prioritize))
+    return vcenters
+
+
+class TargetPool:
+    # Scrapes several vCenter targets concurrently and merges their results into one stream
+    def __init__(self, vcenters, max_workers=8, max_per_vcenter=2, queue_size=1000, verbose=False):
+        self.vcenters = vcenters
+        self.max_workers = max_workers
+        self.max_per_vcenter = max_per_vcenter
+        self.queue_size = queue_size
+        self.verbose = verbose
+        self.failed = list()
+
+    def run(self, collect, limit_concurrency=True):
+        # collect(vcenter) returns an iterable for a connected target, its items are yielded as they arrive.
+        # Long running collectors (watch mode) must run with limit_concurrency=False, otherwise
+        # targets over the limits would never start.
+        results = queue.Queue(maxsize=self.queue_size)
+        workers = threading.Semaphore(self.max_workers)
+        per_vcenter = {vcenter.host: threading.Semaphore(self.max_per_vcenter) for vcenter in self.vcenters}
+
+        def worker(vcenter):
+            try:
+                if limit_concurrency:
+                    per_vcenter[vcenter.host].acquire()
+                    workers.acquire()
+                try:
+                    vcenter.connect()
+                    if self.verbose:
+                        print('Connected to ' + str(vcenter.host) + ', folder ' + ', '.join(vcenter.folders))
+                    for item in collect(vcenter):
+                        results.put(item)
+                finally:
+                    if limit_concurrency:
+                        workers.release()
+                        per_vcenter[vcenter.host].release()
+            except Exception as e:
+                print('Unable to scrape ' + str(vcenter.host) + ', folder ' + ', '.join(vcenter.folders) + ': ', e)
+                self.failed.append(vcenter)
+            finally:
+                results.put(_DONE)
+
+        for vcenter in self.vcenters:
+            threading.Thread(target=worker, args=(vcenter,), daemon=True).start()
+
+        remaining = len(self.vcenters)
+        while remaining:
+            item = results.get()
+            if item is _DONE:
+                remaining -= 1
+            else:
+                yield item
@@ -0,0 +1,32 @@
+import os
+import sys
+import pytest
+
+# The modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vcenter_simulator
+from field_sets import FieldSet, FIELD_SETS
+
+
+@pytest.fixture
+def simulator():
+    return vcenter_simulator.Simulator(vms=60, nics=2, ips=2)
+
+@pytest.fixture
+def make_vcenter(simulator):
+    # Creates connected VMvCenter instances on the simulator
+    vm_vcenter = vcenter_simulator.install(simulator)
+
+    def make_vcenter(field_set='full', **kwargs):
+        vcenter = vm_vcenter.VMvCenter(host='simulator',
+                                       user='user',
+                                       password='password',
+                                       port=443,
+                                       disable_ssl_verification=True,
+                                       folder_path=kwargs.pop('folder_path', 'Lab'),
+                                       field_set=FieldSet.from_names(FIELD_SETS[field_set]),
+                                       **kwargs)
+        vcenter.connect()
+        return vcenter
+    return make_vcenter
@@ -0,0 +1,29 @@
+from enrichment_index import EnrichmentIndex, IndexBuilder
+
+
+def test_index_round_trip(tmp_path, make_vcenter):
+    vm_infos = list(make_vcenter().get_all_vm_info_bulk())
+    builder = IndexBuilder()
+    for vm_info in vm_infos:
+        builder.add(vm_info)
+    builder.write(str(tmp_path / 'index.bin'))
+    index = EnrichmentIndex.load(str(tmp_path / 'index.bin'))
+
+    for vm_info in vm_infos:
+        for nic in vm_info['nic']:
+            found = index.lookup_mac(nic['mac'].upper())
+            assert found['asset'] == vm_info['name']
+            assert found['uuid'] == vm_info['instance_uuid']
+            for address in nic['IP']:
+                ip, prefix_length = address.split('/')
+                found = index.lookup_ip(ip)
+                assert found['asset'] == vm_info['name']
+                assert found['hostname'] == vm_info['host_name']
+                assert found['os'] == vm_info['os']
+                assert found['mac'] == nic['mac']
+                assert found['subnet'].endswith('/' + prefix_length)
+
+    # Unknown addresses in a VM subnet only report the subnet
+    assert index.lookup_ip('10.0.0.254') == {'subnet': '10.0.0.0/24'}
+    assert index.lookup_ip('192.0.2.1') is None
+    assert index.lookup_mac('00:00:5e:00:53:01') is None
@@ -0,0 +1,49 @@
+from snapshot_store import SnapshotStore
+
+
+def publish(store, vm_infos):
+    # What --changes-only passes to the event outputs
+    return [vm_info for vm_info in vm_infos if store.check(vm_info)]
+
+def test_unchanged_vms_are_skipped(tmp_path, simulator, make_vcenter):
+    vcenter = make_vcenter()
+    store = SnapshotStore(str(tmp_path / 'snapshot.db'))
+    assert len(publish(store, vcenter.get_all_vm_info_bulk())) == 60
+    store.commit()
+    store.close()
+
+    # A new run only publishes the changed VMs
+    store = SnapshotStore(str(tmp_path / 'snapshot.db'))
+    simulator.simulate_changes(4)
+    assert len(publish(store, vcenter.get_all_vm_info_bulk())) == 4
+    assert list(store.tombstones({('simulator', 'Datacenter')})) == []
+    store.commit()
+    store.close()
+
+def test_tombstones_for_deleted_vms(tmp_path, simulator, make_vcenter):
+    vcenter = make_vcenter()
+    store = SnapshotStore(str(tmp_path / 'snapshot.db'))
+    publish(store, vcenter.get_all_vm_info_bulk())
+    store.commit()
+
+    deleted = simulator.vms[5]
+    for folder in simulator.content.rootFolder.childEntity[0].vmFolder.childEntity[0].childEntity:
+        folder._properties['childEntity'] = [vm for vm in folder._properties['childEntity'] if vm is not deleted]
+    store = SnapshotStore(str(tmp_path / 'snapshot.db'))
+    assert publish(store, vcenter.get_all_vm_info_bulk()) == []
+    # Targets that did not complete do not report deletions
+    assert list(store.tombstones(set())) == []
+    tombstones = list(store.tombstones({('simulator', 'Datacenter')}))
+    assert [(vm_info['name'], vm_info['removed']) for vm_info in tombstones] == [('vm-000005', True)]
+    store.commit()
+    assert list(store.tombstones({('simulator', 'Datacenter')})) == []
+
+def test_rollback_of_failed_vms(tmp_path, simulator, make_vcenter):
+    vcenter = make_vcenter()
+    store = SnapshotStore(str(tmp_path / 'snapshot.db'))
+    published = publish(store, vcenter.get_all_vm_info_bulk())
+    # Only the VMs an output failed to deliver are published again
+    store.rollback({SnapshotStore.get_key(vm_info) for vm_info in published[:2]})
+    store.commit()
+    republished = publish(store, vcenter.get_all_vm_info_bulk())
+    assert [vm_info['name'] for vm_info in republished] == [vm_info['name'] for vm_info in published[:2]]
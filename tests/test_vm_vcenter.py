@@ -0,0 +1,69 @@
+def without_ts(vm_infos):
+    # Collection modes differ only in the collection time
+    return sorted(({k: v for k, v in vm_info.items() if k != 'ts'} for vm_info in vm_infos), key=lambda vm_info: vm_info['instance_uuid'])
+
+def watch_snapshot(vcenter):
+    # The first rounds of watch mode hold the full inventory, an empty round follows
+    vm_infos = list()
+    for changes in vcenter.watch_vm_info(max_wait=0, page_size=25):
+        if not changes:
+            return vm_infos
+        vm_infos.extend(changes)
+
+
+def test_collection_modes_produce_equal_records(make_vcenter):
+    vcenter = make_vcenter()
+    bulk = without_ts(vcenter.get_all_vm_info_bulk(page_size=25))
+    per_vm = without_ts(vcenter.get_all_vm_info())
+    watch = without_ts(watch_snapshot(vcenter))
+    assert len(bulk) == 60
+    assert bulk == per_vm
+    assert bulk == watch
+
+def test_records_hold_builtin_types(make_vcenter):
+    # powerState and guestState are enums (str subclasses) in pyVmomi
+    for vm_info in make_vcenter().get_all_vm_info_bulk():
+        assert type(vm_info['power_state']) is str
+        assert type(vm_info['guest_state']) is str
+        assert vm_info['power_state'] in ('poweredOn', 'poweredOff')
+
+def test_excluded_folders_are_left_out(make_vcenter):
+    # The simulator puts VM i into folder Lab/Team<i % 10 + 1>
+    vcenter = make_vcenter(exclude=['Lab/Team01', 're:Lab/Team0[23]'])
+    for vm_infos in (vcenter.get_all_vm_info_bulk(), vcenter.get_all_vm_info(), watch_snapshot(vcenter)):
+        indexes = {int(vm_info['name'][len('vm-'):]) for vm_info in vm_infos}
+        assert len(indexes) == 42
+        assert not any(index % 10 in (0, 1, 2) for index in indexes)
+
+def test_relogin_after_session_expired(simulator, make_vcenter):
+    vcenter = make_vcenter()
+    expected = without_ts(vcenter.get_all_vm_info_bulk())
+    simulator.expire_sessions()
+    assert without_ts(vcenter.get_all_vm_info_bulk()) == expected
+    simulator.expire_sessions()
+    assert without_ts(vcenter.get_all_vm_info()) == expected
+
+def test_watch_reports_changes_only(simulator, make_vcenter):
+    vcenter = make_vcenter()
+    rounds = vcenter.watch_vm_info(max_wait=0, page_size=100)
+    assert len(next(rounds)) == 60
+    assert next(rounds) == []
+    simulator.simulate_changes(3)
+    changes = next(rounds)
+    assert len(changes) == 3
+    assert without_ts(changes) == without_ts(vm_info for vm_info in vcenter.get_all_vm_info_bulk()
+                                             if vm_info['instance_uuid'] in {change['instance_uuid'] for change in changes})
+    rounds.close()
+
+def test_watch_resyncs_after_session_expired(simulator, make_vcenter):
+    vcenter = make_vcenter()
+    rounds = vcenter.watch_vm_info(max_wait=0, page_size=100)
+    assert len(next(rounds)) == 60
+    assert next(rounds) == []
+    # The new collector sends the full inventory again, only the differences are reported
+    simulator.expire_sessions()
+    simulator.simulate_changes(2)
+    changes = [change for change in next(rounds)]
+    assert len(changes) == 2
+    assert not any(change.get('removed') for change in changes)
+    rounds.close()
@@ -0,0 +1,502 @@
+import datetime
+import random
+import sys
+import threading
+import time
+import types
+
+# Offline stand-in for the part of the vSphere API used by VMvCenter. Every remote call (managed object
+# property access, PropertyCollector and view manager methods) is counted and can be delayed to mimic
+# the round trip to a real vCenter.
+
+class DataObject:
+    # Plain data object, attribute access is local like with pyVmomi data objects
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __getattr__(self, name):
+        # Unset optional properties read as None, as in pyVmomi
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return None
+
+
+class ManagedObject:
+    # Managed object proxy, every property access is a call to the simulated vCenter
+    def __init__(self, simulator, mo_id, **properties):
+        self._simulator = simulator
+        self._moId = mo_id
+        self._properties = properties
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in self._properties:
+            raise AttributeError(name)
+        self._simulator.call()
+        return self._properties[name]
+
+    def __repr__(self):
+        return "'" + type(self).__name__ + ':' + self._moId + "'"
+
+
+class ManagedEntity(ManagedObject):
+    pass
+
+class VirtualMachine(ManagedEntity):
+    pass
+
+class Folder(ManagedEntity):
+    pass
+
+class Datacenter(ManagedEntity):
+    pass
+
+class HostSystem(ManagedEntity):
+    pass
+
+class ClusterComputeResource(ManagedEntity):
+    pass
+
+class ResourcePool(ManagedEntity):
+    pass
+
+class Datastore(ManagedEntity):
+    pass
+
+class Network(ManagedEntity):
+    pass
+
+class VirtualEthernetCard(DataObject):
+    pass
+
+class Enum(str):
+    # pyVmomi enum values are instances of a str subclass per enum type, not plain strings
+    pass
+
+class PowerState(Enum):
+    pass
+
+class GuestState(Enum):
+    pass
+
+class NotAuthenticated(Exception):
+    pass
+
+class ContainerView(ManagedObject):
+    def DestroyView(self):
+        self._simulator.call()
+
+
+class PropertyCollector:
+    # Supports the retrieval and update methods with traversal, selection and property specs
+    def __init__(self, simulator):
+        self._simulator = simulator
+        self._results = dict()
+        self._filters = list()
+        self._version = 0
+        self._pending = list()
+        self._session = simulator.stub.cookie
+
+    def RetrievePropertiesEx(self, specSet, options):
+        self._simulator.call(session=True)
+        objects = list()
+        for spec in specSet:
+            objects.extend(self._simulator.collect(spec))
+        return self._page(objects, options.maxObjects)
+
+    def ContinueRetrievePropertiesEx(self, token):
+        self._simulator.call(session=True)
+        objects, page_size = self._results.pop(token)
+        return self._page(objects, page_size)
+
+    def _page(self, objects, page_size):
+        page_size = page_size or len(objects) or 1
+        token = None
+        if len(objects) > page_size:
+            token = str(len(self._results) + 1) + '-' + str(id(objects))
+            self._results[token] = (objects[page_size:], page_size)
+        self._simulator.object_cost(min(len(objects), page_size))
+        return DataObject(objects=objects[:page_size], token=token)
+
+    def CreatePropertyCollector(self):
+        self._simulator.call(session=True)
+        return PropertyCollector(self._simulator)
+
+    def DestroyPropertyCollector(self):
+        self._simulator.call()
+
+    def CreateFilter(self, spec, partialUpdates):
+        self._simulator.call()
+        self._filters.append(spec)
+        return DataObject(spec=spec)
+
+    def WaitForUpdatesEx(self, version, options):
+        self._simulator.call(session=True)
+        if self._session != self._simulator.stub.cookie:
+            # Collectors are removed together with the session that created them
+            raise NotAuthenticated()
+        if version == '':
+            self._pending = [('enter', content) for spec in self._filters for content in self._simulator.collect(spec)]
+        if not self._pending:
+            self._pending = [('modify', content) for content in self._simulator.take_changes(self._filters)]
+        if not self._pending:
+            time.sleep(min(options.maxWaitSeconds or 0, self._simulator.max_idle_wait))
+            return None
+
+        page_size = options.maxObjectUpdates or len(self._pending)
+        updates, self._pending = self._pending[:page_size], self._pending[page_size:]
+        self._simulator.object_cost(len(updates))
+        self._version += 1
+        object_set = [DataObject(kind=kind,
+                                 obj=content.obj,
+                                 changeSet=[DataObject(name=prop.name, op='assign', val=prop.val) for prop in content.propSet])
+                      for kind, content in updates]
+        return DataObject(version=str(self._version),
+                          truncated=bool(self._pending),
+                          filterSet=[DataObject(objectSet=object_set)])
+
+
+class ViewManager:
+    def __init__(self, simulator):
+        self._simulator = simulator
+
+    def CreateContainerView(self, container, type, recursive):
+        self._simulator.call(session=True)
+        objects = self._simulator.find(container, tuple(type), recursive)
+        return ContainerView(self._simulator, 'session[sim]view-' + str(id(objects)), view=objects)
+
+
+class SessionManager:
+    def __init__(self, simulator):
+        self._simulator = simulator
+
+    @property
+    def currentSession(self):
+        self._simulator.call()
+        if self._simulator.stub.cookie not in self._simulator.sessions:
+            return None
+        return DataObject(userName='simulator')
+
+    def Login(self, userName, password):
+        # Like pyVmomi, the stub picks up the new session cookie
+        self._simulator.call()
+        self._simulator.stub.cookie = self._simulator.new_session()
+
+
+class Stub:
+    def __init__(self, cookie=None):
+        self.cookie = cookie
+
+
+class ServiceInstance:
+    def __init__(self, simulator, stub):
+        self._simulator = simulator
+        self._stub = stub
+        simulator.stub = stub
+
+    @property
+    def content(self):
+        return self.RetrieveContent()
+
+    def RetrieveContent(self):
+        self._simulator.call()
+        return self._simulator.content
+
+    def CurrentTime(self):
+        self._simulator.call(session=True)
+        return time.time()
+
+
+# Stand-ins for the pyVmomi type namespaces used by VMvCenter
+vim = types.SimpleNamespace(ManagedEntity=ManagedEntity,
+                            VirtualMachine=VirtualMachine,
+                            Folder=Folder,
+                            Datacenter=Datacenter,
+                            HostSystem=HostSystem,
+                            ClusterComputeResource=ClusterComputeResource,
+                            ResourcePool=ResourcePool,
+                            Datastore=Datastore,
+                            Network=Network,
+                            ServiceInstance=None,
+                            fault=types.SimpleNamespace(NotAuthenticated=NotAuthenticated),
+                            view=types.SimpleNamespace(ContainerView=ContainerView),
+                            vm=types.SimpleNamespace(device=types.SimpleNamespace(VirtualEthernetCard=VirtualEthernetCard)))
+
+class _Spec(DataObject):
+    pass
+
+vmodl = types.SimpleNamespace(ManagedObject=ManagedObject, query=types.SimpleNamespace(PropertyCollector=types.SimpleNamespace(
+    SelectionSpec=type('SelectionSpec', (_Spec,), {}),
+    TraversalSpec=type('TraversalSpec', (_Spec,), {}),
+    ObjectSpec=type('ObjectSpec', (_Spec,), {}),
+    PropertySpec=type('PropertySpec', (_Spec,), {}),
+    FilterSpec=type('FilterSpec', (_Spec,), {}),
+    RetrieveOptions=type('RetrieveOptions', (_Spec,), {}),
+    WaitOptions=type('WaitOptions', (_Spec,), {}))))
+
+
+OPERATING_SYSTEMS = [
+    'Ubuntu Linux (64-bit)',
+    'Microsoft Windows Server 2019 (64-bit)',
+    'Microsoft Windows 10 (64-bit)',
+    'Debian GNU/Linux 11 (64-bit)',
+    'Other 3.x or later Linux (64-bit)',
+]
+
+class Simulator:
+    # Synthetic inventory: Datacenter/vm/<folder>/<team folders>/VMs with N NICs and M IPs per NIC
+    def __init__(self, vms=1000, nics=1, ips=2, latency=0.0, object_latency=0.0, folder='Lab', teams=10, seed=1, capacity=0):
+        self.latency = latency
+        self.object_latency = object_latency
+        # Calls served at once before the latency grows with the load, 0 for no limit
+        self.capacity = capacity
+        self.active = 0
+        self.max_idle_wait = 1
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.changes = list()
+        self.sessions = set()
+        self.stub = Stub()
+
+        # Compute resources shared by the VMs
+        cluster = ClusterComputeResource(self, 'domain-c7', name='Cluster01')
+        self.hosts = [HostSystem(self, 'host-' + str(10 + i), name='esx' + str(i + 1).zfill(2) + '.lab.local', parent=cluster) for i in range(4)]
+        cluster._properties['host'] = self.hosts
+        self.resource_pool = ResourcePool(self, 'resgroup-8', name='Resources', parent=cluster)
+        self.datastores = [Datastore(self, 'datastore-' + str(20 + i), name='datastore' + str(i + 1)) for i in range(2)]
+        self.networks = [Network(self, 'network-30', name='VM Network'),
+                         Network(self, 'dvportgroup-31', name='Lab-DPortGroup')]
+        custom_fields = [DataObject(key=101, name='owner'), DataObject(key=102, name='project')]
+
+        self.vms = [self.create_vm(i, nics, ips) for i in range(vms)]
+        team_folders = list()
+        for team in range(teams):
+            team_vms = self.vms[team::teams]
+            team_folders.append(Folder(self, 'group-v' + str(100 + team),
+                                       name='Team' + str(team + 1).zfill(2),
+                                       childEntity=team_vms))
+        base_folder = Folder(self, 'group-v10', name=folder, childEntity=team_folders)
+        vm_folder = Folder(self, 'group-v3', name='vm', childEntity=[base_folder])
+        datacenter = Datacenter(self, 'datacenter-1', name='Datacenter', vmFolder=vm_folder)
+        root_folder = Folder(self, 'group-d1', name='Datacenters', childEntity=[datacenter])
+
+        # Parent links, used by inventory traversals
+        for team_folder in team_folders:
+            team_folder._properties['parent'] = base_folder
+            for vm in team_folder._properties['childEntity']:
+                vm._properties['parent'] = team_folder
+        base_folder._properties['parent'] = vm_folder
+        vm_folder._properties['parent'] = datacenter
+        datacenter._properties['parent'] = root_folder
+        root_folder._properties['parent'] = None
+
+        self.content = DataObject(rootFolder=root_folder,
+                                  viewManager=ViewManager(self),
+                                  propertyCollector=PropertyCollector(self),
+                                  customFieldsManager=DataObject(field=custom_fields),
+                                  sessionManager=SessionManager(self))
+
+    def create_vm(self, index, nics, ips):
+        name = 'vm-' + str(index).zfill(6)
+        nic_infos = list()
+        for nic in range(nics):
+            addresses = list()
+            for ip in range(ips):
+                if ip % 2 == 0:
+                    address = '10.' + str(nic) + '.' + str(index // 250 % 256) + '.' + str(index % 250 + 1)
+                    addresses.append(DataObject(ipAddress=address, prefixLength=24))
+                else:
+                    address = '2001:db8:' + format(nic, 'x') + '::' + format(index, 'x') + ':' + format(ip, 'x')
+                    addresses.append(DataObject(ipAddress=address, prefixLength=64))
+            nic_infos.append(DataObject(connected=True,
+                                        macAddress='00:50:56:' + ':'.join(format((index * 8 + nic) >> shift & 0xff, '02x') for shift in (16, 8, 0)),
+                                        ipConfig=DataObject(ipAddress=addresses)))
+        running = self.random.random() < 0.9
+        devices = list()
+        for nic in range(nics):
+            if nic % 2 == 0:
+                backing = DataObject(deviceName=self.networks[0].name)
+            else:
+                backing = DataObject(port=DataObject(portgroupKey=self.networks[1]._moId))
+            devices.append(VirtualEthernetCard(key=4000 + nic,
+                                               macAddress=nic_infos[nic].macAddress,
+                                               connectable=DataObject(connected=True),
+                                               backing=backing))
+        return VirtualMachine(self, 'vm-' + str(index + 1000),
+                              name=name,
+                              guest=DataObject(hostName=name + '.lab.local',
+                                               guestState=GuestState('running' if running else 'notRunning'),
+                                               guestFullName=self.random.choice(OPERATING_SYSTEMS),
+                                               net=nic_infos),
+                              summary=DataObject(config=DataObject(name=name,
+                                                                   instanceUuid='5000' + str(index).zfill(4) + '-0000-0000-0000-' + str(index).zfill(12))),
+                              runtime=DataObject(powerState=PowerState('poweredOn' if running else 'poweredOff'),
+                                                 bootTime=datetime.datetime(2024, 1, 1) + datetime.timedelta(minutes=index) if running else None,
+                                                 host=self.hosts[index % len(self.hosts)]),
+                              resourcePool=self.resource_pool,
+                              datastore=[self.datastores[index % len(self.datastores)]],
+                              network=self.networks[:min(nics, 2)],
+                              customValue=[DataObject(key=101, value='team' + str(index % 10 + 1).zfill(2))],
+                              config=DataObject(hardware=DataObject(device=devices)))
+
+    def call(self, session=False):
+        with self.lock:
+            self.calls += 1
+            self.active += 1
+            load = self.active / self.capacity if self.capacity else 1
+        try:
+            if self.latency:
+                time.sleep(self.latency * max(load, 1))
+        finally:
+            with self.lock:
+                self.active -= 1
+        if session and self.stub.cookie not in self.sessions:
+            raise NotAuthenticated()
+
+    def new_session(self):
+        with self.lock:
+            cookie = 'vmware_soap_session="' + str(len(self.sessions) + 1) + '"'
+            self.sessions.add(cookie)
+        return cookie
+
+    def expire_sessions(self):
+        # Mimics the server side session timeout
+        with self.lock:
+            self.sessions = set()
+
+    def object_cost(self, count):
+        if self.object_latency:
+            time.sleep(self.object_latency * count)
+
+    def reset_calls(self):
+        with self.lock:
+            self.calls = 0
+
+    def find(self, container, types, recursive):
+        found = list()
+        for child in container._properties.get('childEntity', []):
+            if isinstance(child, types):
+                found.append(child)
+            if recursive and isinstance(child, Folder):
+                found.extend(self.find(child, types, recursive))
+        return found
+
+    def collect(self, filter_spec):
+        # Resolves the object and traversal specs and returns ObjectContent for every selected object
+        named = dict()
+        for obj_spec in filter_spec.objectSet:
+            Simulator.index_specs(obj_spec.selectSet or [], named)
+
+        objects = list()
+        seen = set()
+        for obj_spec in filter_spec.objectSet:
+            if not obj_spec.skip:
+                Simulator.add_object(obj_spec.obj, objects, seen)
+            self.traverse(obj_spec.obj, obj_spec.selectSet or [], named, objects, seen, set())
+
+        contents = list()
+        for obj in objects:
+            for prop_spec in filter_spec.propSet:
+                if isinstance(obj, prop_spec.type):
+                    path_set = list(obj._properties) if prop_spec.all else prop_spec.pathSet
+                    contents.append(DataObject(obj=obj, propSet=[DataObject(name=path, val=value)
+                                                                 for path, value in ((path, Simulator.resolve(obj, path)) for path in path_set)
+                                                                 if value is not None]))
+                    break
+        return contents
+
+    def index_specs(specs, named):
+        for spec in specs:
+            if spec.name and spec.path:
+                if spec.name in named:
+                    continue
+                named[spec.name] = spec
+            Simulator.index_specs(spec.selectSet or [], named)
+
+    def add_object(obj, objects, seen):
+        if id(obj) not in seen:
+            seen.add(id(obj))
+            objects.append(obj)
+
+    def traverse(self, obj, select_set, named, objects, seen, visited):
+        for spec in select_set:
+            if not spec.path:
+                spec = named.get(spec.name)
+                if spec is None:
+                    continue
+            if not isinstance(obj, spec.type):
+                continue
+            key = (id(obj), spec.name, spec.path)
+            if key in visited:
+                continue
+            visited.add(key)
+            children = obj._properties.get(spec.path)
+            if children is None:
+                continue
+            if not isinstance(children, list):
+                children = [children]
+            for child in children:
+                if not spec.skip:
+                    Simulator.add_object(child, objects, seen)
+                self.traverse(child, spec.selectSet or [], named, objects, seen, visited)
+
+    def resolve(obj, path):
+        parts = path.split('.')
+        value = obj._properties.get(parts[0])
+        for part in parts[1:]:
+            if value is None:
+                return None
+            value = getattr(value, part)
+        return value
+
+    def simulate_changes(self, count):
+        # Flips the power state and changes the first IP of count random VMs
+        for vm in self.random.sample(self.vms, min(count, len(self.vms))):
+            runtime = vm._properties['runtime']
+            runtime.powerState = PowerState('poweredOff' if runtime.powerState == 'poweredOn' else 'poweredOn')
+            for nic in vm._properties['guest'].net[:1]:
+                for address in nic.ipConfig.ipAddress[:1]:
+                    if address.prefixLength == 24:
+                        address.ipAddress = '172.16.' + str(self.random.randrange(256)) + '.' + str(self.random.randrange(1, 255))
+            with self.lock:
+                self.changes.append(vm)
+
+    def take_changes(self, filter_specs):
+        with self.lock:
+            changed, self.changes = self.changes, list()
+        changed_ids = {id(vm) for vm in changed}
+        return [content for spec in filter_specs for content in self.collect(spec) if id(content.obj) in changed_ids]
+
+    def SmartConnect(self, **kwargs):
+        self.call()
+        return ServiceInstance(self, Stub(self.new_session()))
+
+    def SmartStubAdapter(self, **kwargs):
+        return Stub()
+
+    def Disconnect(self, si):
+        self.call()
+
+
+def install(simulator):
+    # Points vm_vcenter at the simulator. pyVmomi does not need to be installed.
+    try:
+        import pyVmomi
+    except ImportError:
+        sys.modules['pyVmomi'] = types.SimpleNamespace(vim=vim, vmodl=vmodl)
+        sys.modules['pyVim'] = types.SimpleNamespace()
+        sys.modules['pyVim.connect'] = types.SimpleNamespace(SmartConnect=simulator.SmartConnect,
+                                                             SmartStubAdapter=simulator.SmartStubAdapter,
+                                                             Disconnect=simulator.Disconnect)
+
+    import vm_vcenter
+    vm_vcenter.vim = vim
+    vm_vcenter.vmodl = vmodl
+    vm_vcenter.vim.ServiceInstance = lambda mo_id, stub: ServiceInstance(simulator, stub)
+    vm_vcenter.SmartConnect = simulator.SmartConnect
+    vm_vcenter.SmartStubAdapter = simulator.SmartStubAdapter
+    vm_vcenter.Disconnect = simulator.Disconnect
+    return vm_vcenter
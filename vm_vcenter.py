@@ -1,7 +1,19 @@
 import atexit
-from pyVmomi import vim
-from pyVim.connect import SmartConnect, Disconnect
+import collections
+import difflib
+import fnmatch
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pyVmomi import vim, vmodl
+from pyVim.connect import SmartConnect, SmartStubAdapter, Disconnect
 from datetime import datetime
+from session_cache import SessionCache
+from scheduler import Scheduler
+from metrics import timed_call, vms_collected, vm_errors
+from field_sets import DEFAULT_FIELD_SET
+from serialization import Record
 
 class VMvCenter:
     def __init__(self,
@@ -10,84 +22,637 @@ class VMvCenter:
                  password,
                  port,
                  disable_ssl_verification,
-                 folder_path):
+                 folder_path,
+                 datacenter=None,
+                 field_set=None,
+                 session_cache=None,
+                 keepalive=0,
+                 max_relogins=3,
+                 exclude=None,
+                 scheduler=None,
+                 prioritize=False):
         # Init vars
         self.host = host
         self.user = user
         self.password = password
         self.port = port
         self.disable_ssl_verification = disable_ssl_verification
+        # One or more folder paths to include, below the VM folder of the datacenter
         self.folder_path = folder_path
+        self.folders = [folder_path] if isinstance(folder_path, str) else list(folder_path)
+        # Glob patterns (or regular expressions prefixed with "re:") of folder paths to leave out
+        self.exclude = list(exclude or [])
+        self.datacenter = datacenter
+        self.datacenter_name = datacenter
+        self.field_set = field_set or DEFAULT_FIELD_SET
+        # Number of VMs that could not be collected
+        self.errors = 0
+        # Caches for resolving references to other objects
+        self.names = dict()
+        self.parents = dict()
+        self.custom_fields = None
+        self.content = None
+        # Folder path -> folder, and the IDs of the excluded folders
+        self.folder_index = None
+        self.excluded_folders = set()
+        # Session handling
+        self.session_cache = SessionCache(session_cache) if session_cache else None
+        self.session_key = SessionCache.get_key(host, port, user)
+        self.keepalive = keepalive
+        self.max_relogins = max_relogins
+        self.session_lock = threading.Lock()
+        self.closed = threading.Event()
+        # Rate and concurrency limit of the calls, shared by all targets on the same vCenter
+        self.scheduler = scheduler or Scheduler(host)
+        # Collect powered on and recently changed VMs first
+        self.prioritize = prioritize
+        # VM ID -> time its guest info was last seen changing, and a hash of the guest info
+        self.changed = dict()
+        self.guest_info = dict()
 
     def connect(self):
+        if not (self.session_cache and self.restore_session()):
+            self.login()
+        self.folder_index = None
+
+        if self.session_cache:
+            # Logging out would invalidate the cached session, it is left to expire on the server instead
+            self.session_cache.set(self.session_key, self.si._stub.cookie)
+        else:
+            # Doing this means you don't need to remember to disconnect your script/objects
+            atexit.register(Disconnect, self.si)
+        atexit.register(self.closed.set)
+
+        if self.keepalive:
+            threading.Thread(target=self.send_keepalives, name='keepalive-' + self.host, daemon=True).start()
+
+    def login(self):
+        # The HTTP connection is kept open for the whole run instead of being closed when idle
         if self.disable_ssl_verification:
             self.si = SmartConnect(host=self.host,
                                    user=self.user,
                                    pwd=self.password,
                                    port=self.port,
+                                   connectionPoolTimeout=-1,
                                    disableSslCertValidation=True)
         else:
             self.si = SmartConnect(host=self.host,
                                    user=self.user,
                                    pwd=self.password,
-                                   port=self.port)
-        # Doing this means you don't need to remember to disconnect your script/objects
-        atexit.register(Disconnect, self.si)
+                                   port=self.port,
+                                   connectionPoolTimeout=-1)
+        self.content = None
 
+    def restore_session(self):
+        # Reuses a cached session cookie, saving the login. Returns False when there is no valid session.
+        cookie = self.session_cache.get(self.session_key)
+        if not cookie:
+            return False
+        try:
+            stub = SmartStubAdapter(host=self.host,
+                                    port=self.port,
+                                    connectionPoolTimeout=-1,
+                                    disableSslCertValidation=self.disable_ssl_verification)
+            stub.cookie = cookie
+            si = vim.ServiceInstance('ServiceInstance', stub)
+            if timed_call(self.host, 'currentSession', lambda: si.content.sessionManager.currentSession) is None:
+                return False
+        except Exception:
+            return False
+        self.si = si
+        self.content = None
+        return True
 
-    def get_vm_iterator_from_folder(self):
-        content = self.si.RetrieveContent()
-        
-        # NB! Currently selects the first "Datacenter" as the root folder. If you have more visible for your user, then this needs to be expanded
-        datacenter = content.rootFolder.childEntity[0]
-        
-        # Navigate to the starting base folder
-        container = VMvCenter.get_vm_folder(self.folder_path, datacenter.vmFolder)
-
-        container_view = content.viewManager.CreateContainerView(
-            container,
-            [vim.VirtualMachine], # object types to look for
-            True) # whether we should look into it recursively
-
-        return container_view.view
-
-    def get_vm_folder(path, vm_folder):
-        path = path.split('/')
-
-        for p in path:
-            vm_folder = VMvCenter.get_child(p, vm_folder.childEntity)
-        return vm_folder
-
-    def get_child(name, child_entity):
-        for child in child_entity:
-            if name == child.name:
-                return child
+    def relogin(self, expired_stub=None):
+        # Logs in again on the same connection, so objects fetched before stay usable. Several threads can
+        # notice the expired session at once, only the first one logs in.
+        with self.session_lock:
+            if expired_stub is not None and self.si._stub.cookie != expired_stub:
+                return
+            print('Session to ' + self.host + ' expired, logging in again')
+            try:
+                timed_call(self.host, 'Login', self.get_content().sessionManager.Login, self.user, self.password)
+            except Exception:
+                self.login()
+            if self.session_cache:
+                self.session_cache.set(self.session_key, self.si._stub.cookie)
+
+    def request(self, method, function, *args, tokens=1):
+        # Calls a vCenter method within the rate and concurrency limit of the vCenter
+        return self.scheduler.call(method, lambda: timed_call(self.host, method, function, *args), tokens=tokens)
+
+    def call(self, method, function, *args, tokens=1):
+        # Calls a vCenter method, logging in again when the session has expired
+        for attempt in range(self.max_relogins + 1):
+            cookie = self.si._stub.cookie
+            try:
+                return self.request(method, function, *args, tokens=tokens)
+            except vim.fault.NotAuthenticated:
+                if attempt == self.max_relogins:
+                    raise
+                self.relogin(cookie)
+
+    def send_keepalives(self):
+        # Keeps the session from expiring while idle, e.g. between watch rounds
+        while not self.closed.wait(self.keepalive):
+            try:
+                self.call('CurrentTime', lambda: self.si.CurrentTime())
+            except Exception as e:
+                print('Keepalive to ' + self.host + ' failed: ', e)
+
+    def get_content(self):
+        if self.content is None:
+            self.content = self.si.RetrieveContent()
+        return self.content
+
+
+    def get_container_views(self):
+        # One view per included folder. Folders below another included folder are already in its view.
+        content = self.get_content()
+        folder_index = self.get_folder_index()
+        folders = VMvCenter.get_top_folders([self.get_folder(path, folder_index) for path in self.folders])
+
+        views = list()
+        try:
+            for path in folders:
+                views.append(content.viewManager.CreateContainerView(
+                    folder_index[path],
+                    [vim.VirtualMachine], # object types to look for
+                    True)) # whether we should look into it recursively
+        except Exception:
+            VMvCenter.destroy_views(views)
+            raise
+        return views
+
+    def destroy_views(views):
+        for view in views:
+            try:
+                view.DestroyView()
+            except Exception:
+                # The view is gone with the session it was created in
+                pass
+
+    def get_folder_index(self):
+        # Maps the path of every folder below the VM folder of the datacenter to the folder.
+        # The folder tree is read with one PropertyCollector traversal instead of a call per folder name.
+        if self.folder_index is not None:
+            return self.folder_index
+
+        vm_folder = self.get_datacenter(self.get_content()).vmFolder
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseFolders',
+            path='childEntity',
+            skip=False,
+            type=vim.Folder,
+            selectSet=[vmodl.query.PropertyCollector.SelectionSpec(name='traverseFolders')])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=vm_folder, skip=True, selectSet=[traversal_spec])],
+            propSet=[vmodl.query.PropertyCollector.PropertySpec(type=vim.Folder, pathSet=['name', 'parent'], all=False)])
+        folders = {obj._moId: (obj, props) for obj, props in self.collect_properties(filter_spec)}
+
+        paths = dict()
+        def get_path(key):
+            if key not in paths:
+                obj, props = folders[key]
+                parent = props.get('parent')
+                if parent is None or parent._moId not in folders:
+                    paths[key] = props.get('name')
+                else:
+                    paths[key] = get_path(parent._moId) + '/' + props.get('name')
+            return paths[key]
+
+        folder_index = {get_path(key): obj for key, (obj, props) in folders.items()}
+        # The folder names are known now, VMs referencing their folder need no extra lookup
+        self.names.update({key: props.get('name') for key, (obj, props) in folders.items()})
+        self.excluded_folders = {folder._moId for path, folder in folder_index.items()
+                                 if VMvCenter.is_excluded(path, self.exclude)}
+        self.folder_index = folder_index
+        return folder_index
+
+    def get_folder(self, path, folder_index):
+        path = path.strip('/')
+        if path not in folder_index:
+            message = 'Folder ' + path + ' not found in datacenter ' + str(self.datacenter_name) + ' on ' + self.host
+            suggestions = difflib.get_close_matches(path, folder_index.keys(), n=3)
+            if suggestions:
+                message += '. Did you mean: ' + ', '.join(suggestions) + '?'
+            raise ValueError(message)
+        return path
+
+    def get_top_folders(paths):
+        # Drops duplicate paths and paths below another of the paths
+        top_folders = list()
+        for path in sorted(set(paths)):
+            if not any(path.startswith(top_folder + '/') for top_folder in top_folders):
+                top_folders.append(path)
+        return top_folders
+
+    def is_excluded(path, patterns):
+        # A folder is excluded when its path or the path of one of its parents matches a pattern
+        parts = path.split('/')
+        for i in range(1, len(parts) + 1):
+            prefix = '/'.join(parts[:i])
+            for pattern in patterns:
+                if pattern.startswith('re:'):
+                    if re.fullmatch(pattern[len('re:'):], prefix):
+                        return True
+                elif fnmatch.fnmatchcase(prefix, pattern.strip('/')):
+                    return True
+        return False
+
+    def is_included(self, props):
+        parent = props.get('parent')
+        return parent is None or parent._moId not in self.excluded_folders
+
+    def get_datacenter(self, content):
+        if self.datacenter is None:
+            # Without an explicit datacenter name the first "Datacenter" is used as the root folder
+            datacenter = content.rootFolder.childEntity[0]
+            self.datacenter_name = datacenter.name
+            return datacenter
+
+        datacenter = VMvCenter.find_datacenter(self.datacenter, content.rootFolder)
+        if datacenter is None:
+            raise ValueError('Datacenter ' + self.datacenter + ' not found on ' + self.host)
+        return datacenter
+
+    def find_datacenter(name, folder):
+        # Datacenters can be nested in folders below the root folder
+        for child in folder.childEntity:
+            if isinstance(child, vim.Datacenter):
+                if child.name == name:
+                    return child
+            elif isinstance(child, vim.Folder):
+                datacenter = VMvCenter.find_datacenter(name, child)
+                if datacenter is not None:
+                    return datacenter
         return None
 
+    def record_error(self, e):
+        self.errors += 1
+        vm_errors.inc(1, self.host)
+        print('Error occurred: ', e)
+
+    def tag_vm_info(self, vm_info):
+        vms_collected.inc(1, self.host)
+        vm_info['vcenter'] = self.host
+        vm_info['datacenter'] = self.datacenter_name
+        return vm_info
+
+    def get_vm_iterator_from_folder(self):
+        if self.prioritize:
+            yield from self.get_prioritized_vms()
+            return
+        # The VMs of all views and their folders are listed with one PropertyCollector call, the folder is
+        # needed to leave out VMs in excluded folders. VMs outside of any folder (e.g. in a vApp) have none.
+        views = self.call('CreateContainerView', self.get_container_views)
+        try:
+            vms = self.collect_properties(self.get_filter_spec(views, ['parent']))
+        finally:
+            # Views live as long as the session, which is not logged out with a session cache
+            VMvCenter.destroy_views(views)
+
+        seen = set()
+        for vm, props in vms:
+            if vm._moId in seen or not self.is_included(props):
+                continue
+            seen.add(vm._moId)
+            yield vm
+
     def get_vm_info(self, virtual_machine):
-        vm_info = {
-            'ts': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f') + 'Z',
-            'host_name': virtual_machine.guest.hostName,
-            'guest_state': virtual_machine.guest.guestState,
-            'os': virtual_machine.guest.guestFullName,
-            'name': virtual_machine.summary.config.name,
-            'instance_uuid': virtual_machine.summary.config.instanceUuid,
-            'nic': []
-        }
-
-        # Get network info
-        for nic in virtual_machine.guest.net:
-            if nic.ipConfig is not None:
-                nic_info = {
-                    'connected': nic.connected,
-                    'mac': nic.macAddress,
-                    'IP': [''.join([adr.ipAddress, '/', str(adr.prefixLength)]) for adr in nic.ipConfig.ipAddress],
-                }
-                vm_info['nic'].append(nic_info)
+        # Every top level property is fetched from vCenter once, the rest of the path is read locally
+        top_level = dict()
+        props = dict()
+        for path in self.field_set.paths:
+            parts = path.split('.')
+            if parts[0] not in top_level:
+                top_level[parts[0]] = getattr(virtual_machine, parts[0])
+            value = top_level[parts[0]]
+            for part in parts[1:]:
+                if value is None:
+                    break
+                value = getattr(value, part)
+            props[path] = value
+        self.prepare([props])
+        return self.build_vm_info(props)
 
+    def get_all_vm_info(self):
+        # Legacy collection, every property access is a separate round trip to vCenter. Several VMs are
+        # collected at once, as many as the scheduler allows. At most max_concurrency VMs are read ahead of
+        # the caller, so slow outputs hold up the collection.
+        tokens = len({path.split('.')[0] for path in self.field_set.paths})
+        def collect(vm):
+            try:
+                return vm._moId, self.call('get_vm_info', self.get_vm_info, vm, tokens=tokens)
+            except Exception as e:
+                return vm._moId, e
+
+        def finish(future):
+            key, vm_info = future.result()
+            if isinstance(vm_info, Exception):
+                self.record_error(vm_info)
+                return
+            self.track_changes(key, vm_info)
+            yield self.tag_vm_info(vm_info)
+
+        with ThreadPoolExecutor(max_workers=self.scheduler.max_concurrency) as executor:
+            pending = collections.deque()
+            for vm in self.get_vm_iterator_from_folder():
+                pending.append(executor.submit(collect, vm))
+                if len(pending) >= self.scheduler.max_concurrency:
+                    yield from finish(pending.popleft())
+            while pending:
+                yield from finish(pending.popleft())
+
+    def get_all_vm_info_bulk(self, page_size=1000):
+        # Collects the properties of all VMs in the folder with PropertyCollector, page_size VMs per call.
+        # When the session expires halfway, the retrieval starts over and skips the VMs already collected.
+        collected = set()
+        for attempt in range(self.max_relogins + 1):
+            cookie = self.si._stub.cookie
+            try:
+                for key, vm_info in self.retrieve_vm_info(page_size, collected):
+                    collected.add(key)
+                    self.track_changes(key, vm_info)
+                    yield vm_info
+                return
+            except vim.fault.NotAuthenticated:
+                if attempt == self.max_relogins:
+                    raise
+                self.relogin(cookie)
+
+    def retrieve_vm_info(self, page_size, skip):
+        if self.prioritize:
+            # The VMs are requested by ID in priority order, page_size VMs per call
+            vms = [vm for vm in self.get_prioritized_vms() if vm._moId not in skip]
+            for i in range(0, len(vms), page_size):
+                yield from self.retrieve_pages(self.get_vm_filter_spec(vms[i:i + page_size]), page_size, skip)
+            return
+
+        container_views = self.call('CreateContainerView', self.get_container_views)
+        try:
+            yield from self.retrieve_pages(self.get_filter_spec(container_views), page_size, skip)
+        finally:
+            VMvCenter.destroy_views(container_views)
+
+    def retrieve_pages(self, filter_spec, page_size, skip):
+        collector = self.get_content().propertyCollector
+        result = self.request('RetrievePropertiesEx', collector.RetrievePropertiesEx,
+                              [filter_spec], vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size))
+        while result is not None:
+            page = [(obj.obj._moId, {prop.name: prop.val for prop in obj.propSet})
+                    for obj in result.objects if obj.obj._moId not in skip]
+            page = [(key, props) for key, props in page if self.is_included(props)]
+            self.prepare([props for key, props in page])
+            for key, props in page:
+                try:
+                    yield key, self.tag_vm_info(self.build_vm_info(props))
+                except Exception as e:
+                    self.record_error(e)
+
+            if not result.token:
+                break
+            result = self.request('ContinueRetrievePropertiesEx', collector.ContinueRetrievePropertiesEx, result.token)
+
+    def get_prioritized_vms(self):
+        # Orders the VMs with one cheap call for the power state and boot time of all of them: powered on
+        # VMs first, then the VMs whose guest info changed last. A boot usually changes the guest info
+        # (e.g. a new DHCP lease), the boot time stands in for VMs not seen changing by this process.
+        views = self.call('CreateContainerView', self.get_container_views)
+        try:
+            paths = ['runtime.powerState', 'runtime.bootTime']
+            if self.excluded_folders:
+                paths.append('parent')
+            filter_spec = self.get_filter_spec(views, paths)
+            vms = [(obj, props) for obj, props in self.collect_properties(filter_spec) if self.is_included(props)]
+        finally:
+            VMvCenter.destroy_views(views)
+
+        def priority(item):
+            obj, props = item
+            changed = self.changed.get(obj._moId)
+            if changed is None:
+                boot_time = props.get('runtime.bootTime')
+                changed = boot_time.timestamp() if boot_time is not None else 0
+            return (props.get('runtime.powerState') != 'poweredOn', -changed)
+        return [obj for obj, props in sorted(vms, key=priority)]
+
+    def track_changes(self, key, vm_info):
+        # Remembers when the guest info of a VM changed, for prioritizing the next collection
+        if not self.prioritize:
+            return
+        guest_info = hash(str([vm_info.get(field) for field in ('host_name', 'guest_state', 'nic')]))
+        previous = self.guest_info.get(key)
+        if previous is not None and previous != guest_info:
+            self.changed[key] = time.time()
+        self.guest_info[key] = guest_info
+
+    def create_watch_collector(self, page_size):
+        content = self.get_content()
+        collector = self.call('CreatePropertyCollector', content.propertyCollector.CreatePropertyCollector)
+        container_views = self.call('CreateContainerView', self.get_container_views)
+        collector.CreateFilter(self.get_filter_spec(container_views), partialUpdates=False)
+        return collector, container_views
+
+    def watch_vm_info(self, max_wait=60, page_size=1000):
+        # Yields a list of new, changed and removed VMs for every update round from vCenter.
+        # The first rounds contain the full inventory, afterwards only the changes are reported.
+        # An empty list is yielded when max_wait seconds pass without any changes.
+        # Collectors are bound to the session, when it expires a new collector sends the full inventory
+        # again. Only the differences to the last known state are reported then.
+        collector, container_views = self.create_watch_collector(page_size)
+        options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=max_wait, maxObjectUpdates=page_size)
+
+        vm_props = dict()
+        vm_infos = dict()
+        version = ''
+        resync = None
+        try:
+            while True:
+                cookie = self.si._stub.cookie
+                try:
+                    update = timed_call(self.host, 'WaitForUpdatesEx', collector.WaitForUpdatesEx, version, options)
+                except vim.fault.NotAuthenticated:
+                    self.relogin(cookie)
+                    collector, container_views = self.create_watch_collector(page_size)
+                    version = ''
+                    vm_props = dict()
+                    # VMs not in the new inventory have been removed while the session was gone
+                    resync = set(vm_infos)
+                    continue
+                if update is None:
+                    yield []
+                    continue
+                version = update.version
+
+                changes = list()
+                updated = list()
+                for filter_update in update.filterSet:
+                    for obj_update in filter_update.objectSet:
+                        key = obj_update.obj._moId
+                        if obj_update.kind == 'leave':
+                            vm_props.pop(key, None)
+                            vm_info = vm_infos.pop(key, None)
+                            if vm_info is not None:
+                                changes.append(VMvCenter.build_removed_vm_info(vm_info))
+                            continue
+
+                        props = vm_props.setdefault(key, dict())
+                        for change in obj_update.changeSet:
+                            if change.op in ('remove', 'indirectRemove'):
+                                props.pop(change.name, None)
+                            else:
+                                props[change.name] = change.val
+                        if resync is not None:
+                            resync.discard(key)
+                        if not self.is_included(props):
+                            # Moved into an excluded folder
+                            vm_info = vm_infos.pop(key, None)
+                            if vm_info is not None:
+                                changes.append(VMvCenter.build_removed_vm_info(vm_info))
+                            continue
+                        updated.append(key)
+
+                self.prepare([vm_props[key] for key in updated])
+                for key in updated:
+                    try:
+                        vm_info = self.tag_vm_info(self.build_vm_info(vm_props[key]))
+                    except Exception as e:
+                        self.record_error(e)
+                        continue
+                    # Property changes we do not report on (e.g. guest DNS config) are filtered out here
+                    if not VMvCenter.is_same_vm_info(vm_infos.get(key), vm_info):
+                        vm_infos[key] = vm_info
+                        self.track_changes(key, vm_info)
+                        changes.append(vm_info)
+
+                if resync is not None and not update.truncated:
+                    for key in resync:
+                        changes.append(VMvCenter.build_removed_vm_info(vm_infos.pop(key)))
+                    resync = None
+                yield changes
+        finally:
+            try:
+                collector.DestroyPropertyCollector()
+            except Exception:
+                pass
+            VMvCenter.destroy_views(container_views)
+
+    def is_same_vm_info(old, new):
+        if old is None:
+            return False
+        return {k: v for k, v in old.items() if k != 'ts'} == {k: v for k, v in new.items() if k != 'ts'}
+
+    def build_removed_vm_info(vm_info):
+        removed = Record(vm_info)
+        removed['ts'] = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f') + 'Z'
+        removed['removed'] = True
+        return removed
+
+    def get_filter_spec(self, container_views, paths=None):
+        # Walk from the container views to every VM they hold and request only the properties we need.
+        # The parent folder is needed to leave out VMs in excluded folders.
+        paths = paths or self.get_vm_paths()
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(name='traverseEntities',
+                                                                     path='view',
+                                                                     skip=False,
+                                                                     type=vim.view.ContainerView)
+        obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=container_view,
+                                                              skip=True,
+                                                              selectSet=[traversal_spec])
+                     for container_view in container_views]
+        prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine,
+                                                               pathSet=paths,
+                                                               all=False)
+        return vmodl.query.PropertyCollector.FilterSpec(objectSet=obj_specs,
+                                                        propSet=[prop_spec])
+
+    def get_vm_filter_spec(self, vms):
+        # Requests the properties of the given VMs, in their order
+        obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=vm, skip=False) for vm in vms]
+        prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine,
+                                                               pathSet=self.get_vm_paths(),
+                                                               all=False)
+        return vmodl.query.PropertyCollector.FilterSpec(objectSet=obj_specs,
+                                                        propSet=[prop_spec])
+
+    def get_vm_paths(self):
+        paths = self.field_set.paths
+        if self.excluded_folders and 'parent' not in paths:
+            paths = paths + ['parent']
+        return paths
+
+    def build_vm_info(self, props):
+        # Unset properties are not returned by the PropertyCollector, the field set reads them as None
+        vm_info = Record(ts=datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f') + 'Z')
+        vm_info.update(self.field_set.build(props, self))
         return vm_info
 
-    #def get_all_vm_info(self):
-    #    vms = self.get_vm_iterator_from_folder(self.args.path)
-    #    for vm in vms:
-    #        yield self.get_vm_info(vm)
+    def prepare(self, props_list):
+        # Resolves the names of all objects referenced by the given VMs with at most two calls
+        references = dict()
+        if self.field_set.parent_paths:
+            children = [props.get(path) for props in props_list for path in self.field_set.parent_paths]
+            children = [child for child in children if child is not None]
+            missing = {child._moId: child for child in children if child._moId not in self.parents}
+            for key, props in self.retrieve_properties(missing.values(), vim.ManagedEntity, ['parent']).items():
+                self.parents[key] = props.get('parent')
+            for child in children:
+                parent = self.parents.get(child._moId)
+                if parent is not None and parent._moId not in self.names:
+                    references[parent._moId] = parent
+
+        for props in props_list:
+            for value in props.values():
+                for item in value if isinstance(value, list) else [value]:
+                    if self.is_reference(item) and item._moId not in self.names:
+                        references[item._moId] = item
+        for key, props in self.retrieve_properties(references.values(), vim.ManagedEntity, ['name']).items():
+            self.names[key] = props.get('name')
+
+    def retrieve_properties(self, objects, obj_type, paths):
+        objects = list(objects)
+        if not objects:
+            return dict()
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[vmodl.query.PropertyCollector.ObjectSpec(obj=obj, skip=False) for obj in objects],
+            propSet=[vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=paths, all=False)])
+
+        found = dict()
+        try:
+            for obj, props in self.collect_properties(filter_spec):
+                found[obj._moId] = props
+        except Exception as e:
+            # E.g. an object was deleted meanwhile, the references are reported by their IDs then
+            print('Unable to resolve object names: ', e)
+        return found
+
+    def collect_properties(self, filter_spec):
+        # Returns (object, properties) for every object selected by the filter spec
+        collector = self.get_content().propertyCollector
+        found = list()
+        result = self.call('RetrievePropertiesEx', collector.RetrievePropertiesEx,
+                           [filter_spec], vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=1000))
+        while result is not None:
+            for obj in result.objects:
+                found.append((obj.obj, {prop.name: prop.val for prop in obj.propSet}))
+            if not result.token:
+                break
+            result = self.request('ContinueRetrievePropertiesEx', collector.ContinueRetrievePropertiesEx, result.token)
+        return found
+
+    def is_reference(self, value):
+        return isinstance(value, vmodl.ManagedObject)
+
+    def get_name(self, reference):
+        return self.names.get(reference._moId, reference._moId)
+
+    def get_parent(self, reference):
+        return self.parents.get(reference._moId)
+
+    def get_custom_field_name(self, key):
+        if self.custom_fields is None:
+            manager = self.get_content().customFieldsManager
+            fields = manager.field if manager is not None else []
+            self.custom_fields = {field.key: field.name for field in fields}
+        return self.custom_fields.get(key, str(key))
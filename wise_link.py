@@ -1,16 +1,31 @@
+import gzip
 import json
+import os
+from atomic_file import create_temp, replace
 
 class WiseLink:
-    def __init__(self, file_path, wise_full_mode):
+    def __init__(self, file_path, wise_full_mode, wise_format='json', compress=False):
         self.file_path = file_path
         self.wise_full_mode = wise_full_mode
-        self.wise_data = list()
-        self.ip_duplicates = dict()
+        self.wise_format = wise_format
+        self.compress = compress
+        self.fd = None
         try:
-            self.fd = open(self.file_path, 'w')
+            self.open()
         except Exception as e:
             print('Error occurred: ', e)
 
+    def open(self):
+        # Entries are streamed into a temporary file next to the target, which replaces the target
+        # only once complete. Readers never see a half-written dump.
+        self.tmp_path = create_temp(self.file_path)
+        if self.compress:
+            self.fd = gzip.open(self.tmp_path, 'wt', encoding='utf-8')
+        else:
+            self.fd = open(self.tmp_path, 'w', encoding='utf-8', buffering=1024 * 1024)
+        self.entries = 0
+        if self.wise_format == 'json':
+            self.fd.write('[')
 
     def append(self, info):
         # Wise formatting
@@ -21,10 +36,36 @@ class WiseLink:
                 template["os"] = info.get("os") if info.get("os") != None else "Unknown"
                 template["hostname"] = info.get("host_name") if info.get("host_name") != None else "Unknown"
                 template["mac"] = nicinfo.get("mac", "Unknown")
+            # The entries of a NIC only differ in the IP, the rest is serialized once
+            prefix = None
             for ip in nicinfo.get("IP", []):
                 if len(ip) > 0 and ip is not None:
-                    template["ip"] = ip
-                    self.wise_data.append(template.copy())
+                    if prefix is None:
+                        prefix = json.dumps(template)[:-1] + ', "ip": '
+                    self._write_entry(prefix + json.dumps(ip) + '}')
+
+    def _write_entry(self, entry):
+        if self.wise_format == 'ndjson':
+            self.fd.write(entry + '\n')
+        else:
+            if self.entries > 0:
+                self.fd.write(', ')
+            self.fd.write(entry)
+        self.entries += 1
 
     def write(self):
-        json.dump(self.wise_data, self.fd)
+        # Completes the dump and moves it in place of the target file
+        if self.wise_format == 'json':
+            self.fd.write(']')
+        self.fd.close()
+        replace(self.tmp_path, self.file_path)
+
+    def rewrite(self, infos):
+        # Replaces the file contents with the given VMs, used in watch mode to keep the dump current
+        if self.fd is not None and not self.fd.closed:
+            self.fd.close()
+            os.remove(self.tmp_path)
+        self.open()
+        for info in infos:
+            self.append(info)
+        self.write()